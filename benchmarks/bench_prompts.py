@@ -0,0 +1,145 @@
+"""
+Micro-benchmarks of the prompt parsing and chunking hot path: the two
+copies of `parse_prompt_attention`, the Classic chunker (`tokenize_line`,
+`detokenize`, `get_embed_new`) and the chunker of the emphasis prompt
+processor. Only the CPU work before the text encoders is measured.
+
+    python -m benchmarks.bench_prompts --output prompts.json
+    python -m benchmarks.bench_prompts --prompts long weighted --repeats 20
+"""
+import os
+
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+import json
+import time
+import argparse
+import tempfile
+from types import SimpleNamespace
+
+from stablepy.diffusers_vanilla import prompt_weights, multi_emphasis_prompt
+from stablepy.diffusers_vanilla.multi_emphasis_prompt import StableDiffusionLongPromptProcessor
+from benchmarks.run_benchmarks import stats, environment
+from benchmarks.tiny_models import build_tokenizer, build_sd15_pipeline
+
+_ADJECTIVES = ["red", "blue", "green", "highly detailed", "best quality", "low", "blurry", "bad"]
+_NOUNS = ["cat", "dog", "city", "sky", "hair", "eyes", "light", "portrait", "photo", "hands"]
+_PLACES = ["city", "night", "sky", "light"]
+
+
+def _tag(i):
+    # unique tags, the Classic chunker expects that chunks do not repeat
+    tag = f"{_ADJECTIVES[i % 8]} {_NOUNS[(i // 8) % 10]}"
+    if i >= 80:
+        tag += f" in the {_PLACES[(i // 80) % 4]}"
+    return tag
+
+
+def _long_prompt(n_tags=200):
+    return ", ".join(_tag(i) for i in range(n_tags))
+
+
+def _weighted_prompt(n_tags=120):
+    tags = []
+    for i in range(n_tags):
+        match i % 5:
+            case 0:
+                tags.append(f"({_tag(i)}:1.{i % 9 + 1})")
+            case 1:
+                tags.append(f"(({_tag(i)}))")
+            case 2:
+                tags.append(f"[{_tag(i)}]")
+            case 3:
+                tags.append(f"({_tag(i)}, [{_tag(i + 200)}]:0.8)")
+            case _:
+                tags.append(_tag(i))
+    return ", ".join(tags)
+
+
+def _break_prompt(n_sections=6, n_tags=30):
+    return " BREAK ".join(
+        ", ".join(_tag(s * n_tags + i) for i in range(n_tags)) for s in range(n_sections)
+    )
+
+
+PROMPTS = {
+    "short": "masterpiece, best quality, a photo of a cat with blue eyes",
+    "long": _long_prompt(),
+    "weighted": _weighted_prompt(),
+    "break": _break_prompt(),
+}
+
+
+def timed_calls(fn, repeats, min_time=0.2):
+    """Seconds per call of `fn`, calling it in batches of at least `min_time` seconds."""
+    fn()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    times = [elapsed / number]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    result = stats(times)
+    result["calls_per_run"] = number
+    return result
+
+
+def benchmark_prompt(prompt, tokenizer, processor, repeats):
+    pipeline = SimpleNamespace(tokenizer=tokenizer)
+    tokens = tokenizer.tokenize(prompt.lower().strip())
+
+    def detokenize():
+        prompt_weights.detokenize(list(tokens), prompt.lower().strip())
+
+    results = {
+        "parse_prompt_attention": timed_calls(lambda: prompt_weights.parse_prompt_attention(prompt), repeats),
+        "parse_prompt_attention_emphasis": timed_calls(
+            lambda: multi_emphasis_prompt.parse_prompt_attention(prompt), repeats
+        ),
+        "tokenize_line": timed_calls(lambda: prompt_weights.tokenize_line(prompt, tokenizer), repeats),
+        "detokenize": timed_calls(detokenize, repeats),
+        "get_embed_new": timed_calls(
+            lambda: prompt_weights.get_embed_new(prompt, pipeline, None, only_convert_string=True), repeats
+        ),
+        "emphasis_tokenize_line": timed_calls(lambda: processor.tokenize_line(prompt), repeats),
+    }
+    results["tokens"] = len(tokens)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prompts", nargs="+", default=list(PROMPTS), choices=list(PROMPTS))
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", default=None, help="JSON file, printed to stdout if not set")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        tokenizer = build_tokenizer(work_dir)
+        pipe = build_sd15_pipeline(os.path.join(work_dir, "pipe"))
+    processor = StableDiffusionLongPromptProcessor(pipe, pipe.tokenizer, pipe.text_encoder)
+
+    results = {"environment": environment(), "repeats": args.repeats, "prompts": {}}
+    for name in args.prompts:
+        results["prompts"][name] = benchmark_prompt(PROMPTS[name], tokenizer, processor, args.repeats)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""
+Benchmarks of the main stages of stablepy with tiny random-weight SD1.5 and
+SDXL pipelines. Runs on CPU without network access and writes the timings
+as JSON to compare them between commits:
+
+    python -m benchmarks.run_benchmarks --output results.json
+    python -m benchmarks.run_benchmarks --models sd1.5 --repeats 5
+
+The absolute numbers only make sense on the same machine; the tiny models
+make the Python overhead of each stage visible, not the GPU work.
+"""
+import os
+
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from unittest import mock
+
+import torch
+import diffusers
+
+import stablepy.diffusers_vanilla.adetailer as adetailer_module
+from stablepy import Model_Diffusers, UpscalerESRGAN, GenerationProfiler, ALL_PROMPT_WEIGHT_OPTIONS
+from stablepy.diffusers_vanilla.utils import save_pil_image_with_metadata
+from benchmarks.tiny_models import (
+    save_tiny_model,
+    save_tiny_esrgan,
+    save_tiny_lora,
+    sample_image,
+    sample_mask,
+    stub_detector,
+)
+
+PROMPT = "masterpiece, best quality, (highly detailed:1.2) portrait of a cat with [blue] eyes, night sky"
+NEGATIVE_PROMPT = "worst quality, low quality, (blurry:1.3), bad hands"
+IMAGE_SIZE = 64
+
+
+def stats(times):
+    return {
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "min": min(times),
+        "max": max(times),
+        "runs": len(times),
+    }
+
+
+def timed(fn, repeats, warmup=1):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return stats(times)
+
+
+def timed_stages(model, repeats, warmup=1, **params):
+    """Runs `model(**params)` and returns the statistics of each profiler stage."""
+    stage_times = {}
+    for i in range(warmup + repeats):
+        profiler = GenerationProfiler()
+        start = time.perf_counter()
+        model(profiler=profiler, **params)
+        total = time.perf_counter() - start
+        if i < warmup:
+            continue
+        for name, summary in profiler.summary().items():
+            stage_times.setdefault(name, []).append(summary["wall_time"])
+        stage_times.setdefault("total", []).append(total)
+    return {name: stats(times) for name, times in stage_times.items()}
+
+
+def generation_params(**params):
+    base = dict(
+        prompt=PROMPT,
+        negative_prompt=NEGATIVE_PROMPT,
+        num_steps=4,
+        guidance_scale=7.0,
+        sampler="Euler a",
+        img_width=IMAGE_SIZE,
+        img_height=IMAGE_SIZE,
+        image_resolution=IMAGE_SIZE,
+        seed=1,
+        save_generated_images=False,
+        display_images=False,
+        disable_progress_bar=True,
+    )
+    base.update(params)
+    return base
+
+
+def offline_patches(model_folder):
+    """Stubs for the models stablepy downloads: inpaint ControlNet and the YOLO detectors."""
+    unet = diffusers.UNet2DConditionModel.from_pretrained(model_folder, subfolder="unet")
+
+    def controlnet_from_pretrained(*args, **kwargs):
+        controlnet = diffusers.ControlNetModel.from_unet(unet)
+        return controlnet.to(kwargs.get("torch_dtype") or torch.float32)
+
+    return [
+        mock.patch.object(diffusers.ControlNetModel, "from_pretrained", controlnet_from_pretrained),
+        mock.patch.object(adetailer_module, "hf_hub_download", lambda *args, **kwargs: "stub_detector.pt"),
+        mock.patch.object(adetailer_module, "yolo_detector", stub_detector),
+    ]
+
+
+def benchmark_model(model_type, work_dir, repeats):
+    model_folder = save_tiny_model(model_type, os.path.join(work_dir, f"tiny-{model_type}"))
+    results = {}
+
+    patches = offline_patches(model_folder)
+    for patch in patches:
+        patch.start()
+    try:
+        model = Model_Diffusers(
+            base_model_id=model_folder,
+            task_name="txt2img",
+            type_model_precision=torch.float32,
+        )
+
+        results["load_pipe"] = timed(
+            lambda: model.load_pipe(model_folder, "txt2img", reload=True), repeats
+        )
+
+        lora_paths = [
+            save_tiny_lora(model_folder, os.path.join(work_dir, f"tiny-{model_type}-lora{i}.safetensors"), seed=i)
+            for i in range(3)
+        ]
+        for lora_path in lora_paths:
+            model.process_lora(lora_path, 0.8)
+
+        def swap_lora():
+            model.process_lora(lora_paths[1], 0.8, unload=True)
+            model.process_lora(lora_paths[1], 0.8)
+
+        results["lora_swap"] = timed(swap_lora, repeats)
+        for lora_path in lora_paths:
+            model.process_lora(lora_path, 0.8, unload=True)
+
+        prompt_embeds = {}
+        for syntax_weights in ALL_PROMPT_WEIGHT_OPTIONS:
+            def encode():
+                if hasattr(model, "compel"):
+                    del model.compel
+                model.create_prompt_embeds(PROMPT, NEGATIVE_PROMPT, [], False, syntax_weights)
+            prompt_embeds[syntax_weights] = timed(encode, repeats)
+        results["create_prompt_embeds"] = prompt_embeds
+
+        results["txt2img"] = timed_stages(model, repeats, **generation_params())
+
+        results["adetailer"] = timed_stages(
+            model,
+            repeats,
+            **generation_params(
+                adetailer_A=True,
+                adetailer_A_params={
+                    "face_detector_ad": True,
+                    "person_detector_ad": False,
+                    "hand_detector_ad": False,
+                    "strength": 0.5,
+                },
+            ),
+        )
+
+        model.load_pipe(model_folder, "img2img")
+        results["img2img"] = timed_stages(
+            model, repeats, **generation_params(image=sample_image(IMAGE_SIZE), strength=0.5)
+        )
+
+        model.load_pipe(model_folder, "inpaint")
+        results["inpaint"] = timed_stages(
+            model,
+            repeats,
+            **generation_params(image=sample_image(IMAGE_SIZE), image_mask=sample_mask(IMAGE_SIZE), strength=0.8),
+        )
+    finally:
+        for patch in patches:
+            patch.stop()
+
+    return results
+
+
+def benchmark_upscale_and_save(work_dir, repeats):
+    esrgan_path = save_tiny_esrgan(os.path.join(work_dir, "tiny_esrgan.pth"))
+    image = sample_image(128)
+    upscaler = UpscalerESRGAN(tile=48, tile_overlap=8)
+
+    image_folder = os.path.join(work_dir, "images")
+    metadata = [PROMPT, NEGATIVE_PROMPT, "tiny", None, 4, 7.0, "Euler a", 0, IMAGE_SIZE, IMAGE_SIZE, False]
+
+    return {
+        "esrgan_upscale": timed(lambda: upscaler.upscale(image, 2, esrgan_path), repeats),
+        "save_image": timed(lambda: save_pil_image_with_metadata(image, image_folder, metadata), repeats),
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+        "commit": commit,
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "diffusers": diffusers.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "threads": torch.get_num_threads(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models", nargs="+", default=["sd1.5", "sdxl"], choices=["sd1.5", "sdxl"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--output", default=None, help="JSON file, printed to stdout if not set")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    results = {"environment": environment(), "repeats": args.repeats, "models": {}}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for model_type in args.models:
+            results["models"][model_type] = benchmark_model(model_type, work_dir, args.repeats)
+        results["upscale_and_save"] = benchmark_upscale_and_save(work_dir, args.repeats)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Tiny random-weight models in the shapes stablepy expects. Everything is
+built locally with fixed seeds, no network access is needed.
+"""
+import os
+import json
+import tempfile
+import torch
+from PIL import Image, ImageDraw
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+from diffusers import (
+    AutoencoderKL,
+    EulerDiscreteScheduler,
+    StableDiffusionPipeline,
+    StableDiffusionXLPipeline,
+    UNet2DConditionModel,
+)
+
+# Words merged into single tokens, the rest of the text is tokenized by characters
+VOCAB_WORDS = [
+    "a", "photo", "of", "cat", "dog", "masterpiece", "best", "quality", "highly", "detailed",
+    "portrait", "city", "red", "blue", "green", "hair", "eyes", "light", "night", "sky",
+    "worst", "low", "blurry", "bad", "hands", "and", "with", "the", "in", "BREAK",
+]
+
+
+def _bytes_to_unicode():
+    # same byte to unicode table as the CLIP tokenizer
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2**8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2**8 + n)
+            n += 1
+    return [chr(c) for c in cs]
+
+
+def build_tokenizer(folder):
+    """CLIP tokenizer with a character vocabulary plus the merges of `VOCAB_WORDS`."""
+    chars = _bytes_to_unicode()
+    vocab = chars + [c + "</w>" for c in chars]
+    merges = []
+    for word in VOCAB_WORDS:
+        word = word.lower()
+        if len(word) == 1:
+            continue
+        current = word[0]
+        for ch in word[1:-1]:
+            merges.append((current, ch))
+            current += ch
+        merges.append((current, word[-1] + "</w>"))
+    merges = list(dict.fromkeys(merges))
+    for a, b in merges:
+        if a + b not in vocab:
+            vocab.append(a + b)
+    vocab += ["<|startoftext|>", "<|endoftext|>"]
+
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, "vocab.json"), "w") as f:
+        json.dump({token: i for i, token in enumerate(vocab)}, f)
+    with open(os.path.join(folder, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n" + "\n".join(f"{a} {b}" for a, b in merges) + "\n")
+
+    return CLIPTokenizer(
+        os.path.join(folder, "vocab.json"),
+        os.path.join(folder, "merges.txt"),
+        model_max_length=77,
+    )
+
+
+def _text_config(tokenizer, projection_dim=32):
+    # 12 layers like CLIP ViT-L, the SDXL prompt processor reads hidden_states[11]
+    return CLIPTextConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=12,
+        projection_dim=projection_dim,
+        max_position_embeddings=77,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        hidden_act="gelu",
+    )
+
+
+def _vae():
+    return AutoencoderKL(
+        block_out_channels=(16, 16, 32, 32),
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+        norm_num_groups=8,
+        sample_size=64,
+    )
+
+
+def _scheduler():
+    return EulerDiscreteScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        steps_offset=1,
+    )
+
+
+def build_sd15_pipeline(folder, seed=0):
+    torch.manual_seed(seed)
+    tokenizer = build_tokenizer(folder)
+    text_encoder = CLIPTextModel(_text_config(tokenizer))
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=8,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+        attention_head_dim=4,
+        norm_num_groups=8,
+    )
+    return StableDiffusionPipeline(
+        vae=_vae(),
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        scheduler=_scheduler(),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+
+
+def build_sdxl_pipeline(folder, seed=0):
+    torch.manual_seed(seed)
+    tokenizer = build_tokenizer(folder)
+    text_encoder = CLIPTextModel(_text_config(tokenizer))
+    # the pooled output is recognized by its OpenCLIP bigG size
+    text_encoder_2 = CLIPTextModelWithProjection(_text_config(tokenizer, projection_dim=1280))
+    unet = UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=8,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4),
+        use_linear_projection=True,
+        addition_embed_type="text_time",
+        addition_time_embed_dim=8,
+        transformer_layers_per_block=(1, 2),
+        projection_class_embeddings_input_dim=1328,  # 6 * 8 + 1280
+        cross_attention_dim=64,
+        norm_num_groups=8,
+    )
+    return StableDiffusionXLPipeline(
+        vae=_vae(),
+        text_encoder=text_encoder,
+        text_encoder_2=text_encoder_2,
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer,
+        unet=unet,
+        scheduler=_scheduler(),
+        force_zeros_for_empty_prompt=False,
+    )
+
+
+def save_tiny_model(model_type, folder, seed=0):
+    """Saves a tiny pipeline of `model_type` ("sd1.5" or "sdxl") as a local diffusers folder."""
+    builder = build_sdxl_pipeline if model_type == "sdxl" else build_sd15_pipeline
+    with tempfile.TemporaryDirectory() as vocab_folder:
+        pipe = builder(vocab_folder, seed)
+        pipe.save_pretrained(folder, safe_serialization=True)
+    return folder
+
+
+def save_tiny_esrgan(path, seed=0):
+    """Saves a random 4x RRDBNet in the ESRGAN checkpoint format."""
+    from stablepy.upscalers.esrgan import RRDBNet
+
+    torch.manual_seed(seed)
+    model = RRDBNet(in_nc=3, out_nc=3, nf=8, nb=1, upscale=4)
+    torch.save(model.state_dict(), path)
+    return path
+
+
+def sample_image(size=64):
+    image = Image.new("RGB", (size, size), (90, 120, 200))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((size // 4, size // 4, 3 * size // 4, 3 * size // 4), fill=(230, 190, 150))
+    return image
+
+
+def sample_mask(size=64):
+    mask = Image.new("L", (size, size), 0)
+    ImageDraw.Draw(mask).rectangle((size // 4, size // 4, 3 * size // 4, 3 * size // 4), fill=255)
+    return mask
+
+
+def stub_detector(image, model_path=None, confidence=0.3):
+    """Replacement of `yolo_detector` that always finds one object in the center."""
+    return [sample_mask(image.size[0]).resize(image.size)]
+
+
+LORA_UNET_TARGETS = ("to_q", "to_k", "to_v", "to_out.0", "proj_in", "proj_out", "ff.net.0.proj", "ff.net.2")
+LORA_TEXT_ENCODER_TARGETS = ("q_proj", "k_proj", "v_proj", "out_proj", "fc1", "fc2")
+
+
+def _lora_layers(state_dict, prefix, model, targets, rank, alpha):
+    for name, module in model.named_modules():
+        if not name.endswith(targets) or not isinstance(module, (torch.nn.Linear, torch.nn.Conv2d)):
+            continue
+        weight = module.weight
+        key = f"{prefix}_{name.replace('.', '_')}"
+        down_shape = (rank, weight.shape[1]) + tuple(weight.shape[2:])
+        up_shape = (weight.shape[0], rank) + (1,) * (weight.dim() - 2)
+        state_dict[f"{key}.lora_down.weight"] = torch.randn(down_shape) * 0.1
+        state_dict[f"{key}.lora_up.weight"] = torch.randn(up_shape) * 0.1
+        state_dict[f"{key}.alpha"] = torch.tensor(float(alpha))
+
+
+def save_tiny_lora(model_folder, path, rank=4, alpha=2.0, seed=0, text_encoder=True):
+    """Saves a random LoRA in the kohya format for the tiny model saved in `model_folder`."""
+    from safetensors.torch import save_file
+    from transformers import CLIPTextModel
+
+    torch.manual_seed(seed)
+    state_dict = {}
+    unet = UNet2DConditionModel.from_pretrained(model_folder, subfolder="unet")
+    _lora_layers(state_dict, "lora_unet", unet, LORA_UNET_TARGETS, rank, alpha)
+    if text_encoder:
+        is_sdxl = os.path.isdir(os.path.join(model_folder, "text_encoder_2"))
+        te = CLIPTextModel.from_pretrained(model_folder, subfolder="text_encoder")
+        _lora_layers(state_dict, "lora_te1" if is_sdxl else "lora_te", te, LORA_TEXT_ENCODER_TARGETS, rank, alpha)
+        if is_sdxl:
+            te_2 = CLIPTextModelWithProjection.from_pretrained(model_folder, subfolder="text_encoder_2")
+            _lora_layers(state_dict, "lora_te2", te_2, LORA_TEXT_ENCODER_TARGETS, rank, alpha)
+    save_file(state_dict, path)
+    return path
@@ -2,6 +2,11 @@ from .__version__ import __version__
 from .diffusers_vanilla.model import Model_Diffusers
 from .diffusers_vanilla.adetailer import ad_model_process
 from .diffusers_vanilla import utils
+from .diffusers_vanilla.worker_pool import ModelWorkerPool, WorkerError
+from .diffusers_vanilla.async_generation import AsyncModelDiffusers
+from .diffusers_vanilla.cancellation import CancellationToken, GenerationCancelled, GenerationTimeout
+from .diffusers_vanilla.instrumentation import GenerationProfiler, log_hook, JsonLinesHook, PrometheusHook
+from .diffusers_vanilla.tracing import ChromeTraceRecorder, start_trace, stop_trace
 from .upscalers.esrgan import UpscalerESRGAN, UpscalerLanczos, UpscalerNearest
 from .logging.logging_setup import logger
 from .diffusers_vanilla.constants import (
@@ -9,6 +9,10 @@ import numpy as np
 from PIL import Image
 import torch, copy, gc
 from ..logging.logging_setup import logger
+from .cancellation import GenerationCancelled
+from .instrumentation import profile_stage
+from .tracing import trace_span
+from .timesteps_cache import copy_scheduler
 
 def ad_model_process(
     detailfix_pipe,
@@ -20,11 +24,12 @@ def ad_model_process(
     mask_dilation=4,
     mask_blur=4,
     mask_padding=32,
+    profiler=None,
 ):
     # input: params pipe, detailfix_pipe, paras yolo
     # output: list of PIL images
 
-    scheduler_assigned = copy.deepcopy(detailfix_pipe.scheduler)
+    scheduler_assigned = detailfix_pipe.scheduler
     logger.debug(f"Base sampler detailfix_pipe: {scheduler_assigned}")
 
     detailfix_pipe.safety_checker = None
@@ -63,7 +68,8 @@ def ad_model_process(
         final_image = None
 
         for j, detector in enumerate(detectors):
-            masks = detector(init_image)
+            with profile_stage(profiler, "adetailer_detect"), trace_span("adetailer_detect", image=i, detector=j):
+                masks = detector(init_image)
 
             if masks is None:
                 logger.info(
@@ -92,7 +98,10 @@ def ad_model_process(
                     pipe_params_df["control_image"] = make_inpaint_condition(crop_image, crop_mask)
 
                 try:
-                    inpaint_output = detailfix_pipe(**pipe_params_df)
+                    with profile_stage(profiler, "adetailer_inpaint"), trace_span("adetailer_inpaint", image=i, mask=k):
+                        inpaint_output = detailfix_pipe(**pipe_params_df)
+                except GenerationCancelled:
+                    raise
                 except Exception as e:
                     e = str(e)
                     if "Tensor with 2 elements cannot be converted to Scalar" in e:
@@ -106,7 +115,7 @@ def ad_model_process(
                         except Exception as ex:
                             logger.error("trying with base sampler")
                             logger.debug(str(ex))
-                            detailfix_pipe.scheduler = detailfix_pipe.default_scheduler
+                            detailfix_pipe.scheduler = copy_scheduler(detailfix_pipe.default_scheduler)
 
                             inpaint_output = detailfix_pipe(**pipe_params_df)
                     elif "The size of tensor a (0) must match the size of tensor b (3) at non-singleton" in e or "cannot reshape tensor of 0 elements into shape [0, -1, 1, 512] because the unspecified dimensi" in e:
@@ -0,0 +1,85 @@
+# =====================================
+# Asyncio front-end
+# =====================================
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from .cancellation import CancellationToken
+from ..logging.logging_setup import logger
+
+
+class AsyncModelDiffusers:
+    """
+    Runs the generations of a `Model_Diffusers` on a dedicated executor thread
+    so they can be awaited from an asyncio event loop.
+
+    At most `max_queue_size` generations are accepted at once (running plus
+    waiting). Cancelling the awaiting task cancels the generation: a waiting
+    job is dropped and a running one stops after its current denoising step.
+
+    Example:
+        model = AsyncModelDiffusers(Model_Diffusers(base_model_id))
+        images, image_paths = await model.generate(prompt="a cat", num_steps=20)
+    """
+
+    def __init__(self, model, max_queue_size=8):
+        self.model = model
+        self.max_queue_size = max_queue_size
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stablepy")
+        self._semaphore = None
+        self._queued = 0
+
+    @property
+    def queue_size(self):
+        """Number of accepted generations, running or waiting."""
+        return self._queued
+
+    def full(self):
+        return self._queued >= self.max_queue_size
+
+    async def generate(self, *, block=True, **kwargs):
+        """
+        Awaits a generation with the same parameters as `Model_Diffusers.__call__`
+        and returns its `(images, image_paths)`.
+
+        If the queue is full it waits for a free slot, or raises
+        `asyncio.QueueFull` when `block=False`.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_queue_size)
+
+        if not block and self._semaphore.locked():
+            raise asyncio.QueueFull(f"Generation queue is full ({self.max_queue_size})")
+        await self._semaphore.acquire()
+        self._queued += 1
+
+        loop = asyncio.get_running_loop()
+        token = kwargs.pop("cancellation_token", None) or CancellationToken()
+        future = self._executor.submit(
+            functools.partial(self.model, cancellation_token=token, **kwargs)
+        )
+        # the slot is freed when the job really ends, not when the awaiter gives up
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._release)
+        )
+
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            logger.info("Generation cancelled by the caller")
+            token.cancel()
+            future.cancel()
+            raise
+
+    def _release(self):
+        self._queued -= 1
+        self._semaphore.release()
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close(wait=False)
@@ -0,0 +1,89 @@
+# =====================================
+# Cancellation
+# =====================================
+import gc
+import time
+import threading
+import inspect
+import functools
+import traceback
+import torch
+from ..logging.logging_setup import logger
+
+
+class GenerationCancelled(Exception):
+    """Raised inside a generation when its CancellationToken was cancelled."""
+
+
+class GenerationTimeout(GenerationCancelled):
+    """Raised inside a generation when its deadline has passed."""
+
+
+class CancellationToken:
+    """
+    Thread-safe flag to abort a running generation. It is checked after each
+    denoising step and between pipeline stages, so `cancel()` can be called
+    from any thread. An optional `deadline` (a `time.time()` value) cancels
+    the generation once it has passed.
+    """
+
+    def __init__(self, deadline=None):
+        self._event = threading.Event()
+        self.deadline = deadline
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def with_deadline(self, deadline):
+        """Returns a token cancelled together with this one that also expires at `deadline`."""
+        token = CancellationToken(deadline)
+        token._event = self._event
+        if self.deadline is not None:
+            token.deadline = min(self.deadline, deadline)
+        return token
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise GenerationCancelled("The generation was cancelled")
+        if self.deadline is not None and time.time() > self.deadline:
+            raise GenerationTimeout("The generation exceeded its deadline")
+
+    def step_callback(self, step, timestep, latents):
+        self.raise_if_cancelled()
+
+
+def release_on_cancel(func):
+    """
+    Frees the memory held by a cancelled generation before the exception
+    reaches the caller: the locals of the failed frames (latents, images,
+    embeddings) would otherwise stay alive as long as the traceback does.
+    Works with plain and generator functions.
+    """
+    def release(e):
+        logger.info(f"{e}; releasing memory")
+        traceback.clear_frames(e.__traceback__)
+        gc.collect()
+        torch.cuda.empty_cache()
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return (yield from func(*args, **kwargs))
+            except GenerationCancelled as e:
+                release(e)
+                raise
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except GenerationCancelled as e:
+                release(e)
+                raise
+
+    return wrapper
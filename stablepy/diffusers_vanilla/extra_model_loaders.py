@@ -12,6 +12,18 @@ import torch
 from ..logging.logging_setup import logger
 
 
+def load_detailfix_controlnet(torch_dtype=torch.float16):
+    """Inpaint ControlNet of the SD 1.5 detailfix pipeline."""
+    if torch_dtype == torch.float16:
+        type_params = {"torch_dtype": torch.float16, "variant": "fp16"}
+    else:
+        type_params = {"torch_dtype": torch.float32}
+    logger.debug(f"Params detailfix sd controlnet {type_params}")
+    return ControlNetModel.from_pretrained(
+        "lllyasviel/control_v11p_sd15_inpaint", **type_params,
+    )
+
+
 def custom_task_model_loader(
     pipe,
     model_category="detailfix",
@@ -22,14 +34,7 @@ def custom_task_model_loader(
     if model_category == "detailfix":
         if not hasattr(pipe, "text_encoder_2"):
             # sd df
-            if torch_dtype == torch.float16:
-                type_params = {"torch_dtype": torch.float16, "variant": "fp16"}
-            else:
-                type_params = {"torch_dtype": torch.float32}
-            logger.debug(f"Params detailfix sd controlnet {type_params}")
-            controlnet_detailfix = ControlNetModel.from_pretrained(
-                "lllyasviel/control_v11p_sd15_inpaint", **type_params,
-            )
+            controlnet_detailfix = load_detailfix_controlnet(torch_dtype)
             detailfix_pipe = StableDiffusionControlNetInpaintPipeline(
                 vae=pipe.vae,
                 text_encoder=pipe.text_encoder,
@@ -124,3 +129,26 @@ def custom_task_model_loader(
             raise ValueError("Animatediff not implemented for SDXL")
 
         return animatediff_pipe
+
+
+def share_components(task_pipe, pipe, torch_dtype=torch.float16):
+    """
+    Points the components of a pipeline built by `custom_task_model_loader` to the
+    current ones of `pipe` (scheduler, IP adapter image encoder...). Its own
+    ControlNet is kept, and loaded again if `release_controlnet` freed it.
+    """
+    if "controlnet" in task_pipe.components and task_pipe.controlnet is None:
+        task_pipe.controlnet = load_detailfix_controlnet(torch_dtype)
+    for name in task_pipe.components:
+        if name == "controlnet" or not hasattr(pipe, name):
+            continue
+        component = getattr(pipe, name)
+        if getattr(task_pipe, name) is not component:
+            setattr(task_pipe, name, component)
+    return task_pipe
+
+
+def release_controlnet(task_pipe):
+    """Frees the ControlNet weights of `task_pipe`, `share_components` loads them again."""
+    if "controlnet" in task_pipe.components and task_pipe.controlnet is not None:
+        task_pipe.controlnet = None
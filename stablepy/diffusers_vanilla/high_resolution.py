@@ -2,6 +2,8 @@ from ..upscalers.esrgan import UpscalerESRGAN, UpscalerLanczos, UpscalerNearest
 from ..logging.logging_setup import logger
 import torch, gc
 from diffusers import DDIMScheduler
+from .cancellation import GenerationCancelled
+from .instrumentation import profile_stage
 
 def process_images_high_resolution(
     images,
@@ -11,6 +13,7 @@ def process_images_high_resolution(
     task_name=None,
     generator=None,
     hires_pipe=None,
+    profiler=None,
     ):
 
     def upscale_images(images, upscaler_model_path, esrgan_tile, esrgan_tile_overlap):
@@ -49,6 +52,8 @@ def process_images_high_resolution(
                         image=img_pre_hires,
                         **hires_params_config,
                     ).images[0]
+                except GenerationCancelled:
+                    raise
                 except Exception as e:
                     e = str(e)
                     if "Tensor with 2 elements cannot be converted to Scalar" in e:
@@ -76,7 +81,9 @@ def process_images_high_resolution(
                 images = [control_image_up] + images
         return images
 
-    images = upscale_images(images, upscaler_model_path, esrgan_tile, esrgan_tile_overlap)
-    images = hires_fix(images)
+    with profile_stage(profiler, "upscale"):
+        images = upscale_images(images, upscaler_model_path, esrgan_tile, esrgan_tile_overlap)
+    with profile_stage(profiler, "hires_fix"):
+        images = hires_fix(images)
 
     return images
@@ -0,0 +1,275 @@
+# =====================================
+# Generation instrumentation
+# =====================================
+import os
+import sys
+import json
+import time
+import inspect
+import functools
+import threading
+from contextlib import contextmanager, nullcontext
+import torch
+from ..logging.logging_setup import logger
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def current_rss():
+    """Resident set size of the process in bytes, None if unknown."""
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes, None if unknown."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class GenerationProfiler:
+    """
+    Records wall time, RSS and VRAM usage of the stages of a generation, and
+    the duration of each denoising step. Every record is a dict appended to
+    `records` and sent to each hook as `hook(record)`.
+
+    Stage records: name, depth, wall_time, rss, rss_delta, peak_rss,
+    vram_allocated_delta, vram_peak (bytes; VRAM values are None without CUDA),
+    aborted (the stage was ended by an exception or a cancellation).
+    Step records: stage, step, wall_time, vram_allocated.
+
+    The VRAM peak of each stage resets the process-wide CUDA peak counter
+    (`torch.cuda.reset_peak_memory_stats`); with `vram_peak=False` it is left
+    alone and the stages have no VRAM peak. With `memory=False` only the times
+    are measured and every memory value is None.
+
+    Example:
+        profiler = GenerationProfiler(hooks=[log_hook, JsonLinesHook("trace.jsonl")])
+        images, image_paths = model(prompt="a cat", profiler=profiler)
+        profiler.summary()
+    """
+
+    def __init__(self, hooks=None, vram_peak=True, memory=True):
+        self.hooks = list(hooks) if hooks else []
+        self.records = []
+        self._open = []
+        self._last_step = None
+        self._memory = memory
+        self._cuda = memory and torch.cuda.is_available()
+        self._vram_peak = self._cuda and vram_peak
+
+    def begin(self, name):
+        if self._vram_peak:
+            # keep the peak of the enclosing stages before resetting the counter
+            current_peak = torch.cuda.max_memory_allocated()
+            for stage in self._open:
+                stage["vram_peak"] = max(stage["vram_peak"], current_peak)
+            torch.cuda.reset_peak_memory_stats()
+
+        rss = current_rss() if self._memory else None
+        self._open.append({
+            "name": name,
+            "start": time.perf_counter(),
+            "rss": rss,
+            "vram_allocated": torch.cuda.memory_allocated() if self._cuda else None,
+            "vram_peak": 0,
+        })
+        self._last_step = None
+
+    def end(self, name=None, aborted=False):
+        stage = self._open.pop()
+        if name is not None and stage["name"] != name:
+            raise ValueError(f"Profiler stage '{name}' ended while '{stage['name']}' was open")
+
+        rss = current_rss() if self._memory else None
+        record = {
+            "type": "stage",
+            "name": stage["name"],
+            "depth": len(self._open),
+            "wall_time": time.perf_counter() - stage["start"],
+            "rss": rss,
+            "rss_delta": rss - stage["rss"] if rss is not None and stage["rss"] is not None else None,
+            "peak_rss": peak_rss() if self._memory else None,
+            "vram_allocated_delta": None,
+            "vram_peak": None,
+            "aborted": aborted,
+        }
+        if self._cuda:
+            record["vram_allocated_delta"] = torch.cuda.memory_allocated() - stage["vram_allocated"]
+        if self._vram_peak:
+            vram_peak = max(stage["vram_peak"], torch.cuda.max_memory_allocated())
+            record["vram_peak"] = vram_peak
+            for parent in self._open:
+                parent["vram_peak"] = max(parent["vram_peak"], vram_peak)
+        self._last_step = None
+        self.emit(record)
+        return record
+
+    def end_open(self, depth=0):
+        """Ends as aborted the stages still open above `depth`."""
+        while len(self._open) > depth:
+            self.end(aborted=True)
+
+    @contextmanager
+    def stage(self, name):
+        self.begin(name)
+        try:
+            yield
+        except BaseException:
+            self.end(name, aborted=True)
+            raise
+        self.end(name)
+
+    def step_callback(self, step, timestep, latents):
+        now = time.perf_counter()
+        if self._last_step is None:
+            # the first step is measured from the start of its stage
+            self._last_step = self._open[-1]["start"] if self._open else now
+        self.emit({
+            "type": "step",
+            "stage": self._open[-1]["name"] if self._open else None,
+            "step": step,
+            "wall_time": now - self._last_step,
+            "vram_allocated": torch.cuda.memory_allocated() if self._cuda else None,
+        })
+        self._last_step = now
+
+    def emit(self, record):
+        self.records.append(record)
+        for hook in self.hooks:
+            try:
+                hook(record)
+            except Exception as e:
+                logger.debug(f"Profiler hook failed: {str(e)}")
+
+    def summary(self):
+        """Total wall time, number of calls and VRAM peak of each stage name."""
+        summary = {}
+        for record in self.records:
+            if record["type"] != "stage":
+                continue
+            stage = summary.setdefault(record["name"], {"calls": 0, "wall_time": 0.0, "vram_peak": None})
+            stage["calls"] += 1
+            stage["wall_time"] += record["wall_time"]
+            if record["vram_peak"] is not None:
+                stage["vram_peak"] = max(stage["vram_peak"] or 0, record["vram_peak"])
+        return summary
+
+
+def profile_stage(profiler, name):
+    """`profiler.stage(name)`, or a no-op context when `profiler` is None."""
+    return profiler.stage(name) if profiler is not None else nullcontext()
+
+
+def ends_open_stages(function):
+    """
+    Decorates a function or generator with a `profiler` argument that opens its stages
+    with `begin`/`end`: the stages it leaves open when it raises, is cancelled or is
+    closed early are ended as aborted, so the profiler can be reused.
+    """
+    signature = inspect.signature(function)
+
+    def profiler_argument(args, kwargs):
+        return signature.bind(*args, **kwargs).arguments.get("profiler")
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = profiler_argument(args, kwargs)
+            depth = len(profiler._open) if profiler is not None else 0
+            try:
+                return (yield from function(*args, **kwargs))
+            finally:
+                if profiler is not None:
+                    profiler.end_open(depth)
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = profiler_argument(args, kwargs)
+            depth = len(profiler._open) if profiler is not None else 0
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if profiler is not None:
+                    profiler.end_open(depth)
+    return wrapper
+
+
+# =====================================
+# Hooks
+# =====================================
+
+
+def log_hook(record):
+    if record["type"] == "stage":
+        vram = f", VRAM peak {record['vram_peak'] / 2**20:.0f} MiB" if record["vram_peak"] is not None else ""
+        logger.info(f"{'  ' * record['depth']}{record['name']}: {record['wall_time']:.3f}s{vram}")
+    else:
+        logger.debug(f"{record['stage']} step {record['step']}: {record['wall_time']:.3f}s")
+
+
+class JsonLinesHook:
+    """Appends each record as a JSON line to `path`."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(dict(record, time=time.time()))
+        with self._lock, open(self.path, "a") as trace_file:
+            trace_file.write(line + "\n")
+
+
+class PrometheusHook:
+    """
+    Aggregates the records into Prometheus-style counters; `render()` returns
+    them in the text exposition format to serve them from a /metrics endpoint.
+    """
+
+    def __init__(self, prefix="stablepy"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.stage_vram_peak = {}
+        self.steps = 0
+        self.step_seconds = 0.0
+
+    def __call__(self, record):
+        with self._lock:
+            if record["type"] == "step":
+                self.steps += 1
+                self.step_seconds += record["wall_time"]
+                return
+            name = record["name"]
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + record["wall_time"]
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+            if record["vram_peak"] is not None:
+                self.stage_vram_peak[name] = max(self.stage_vram_peak.get(name, 0), record["vram_peak"])
+
+    def render(self):
+        p = self.prefix
+        with self._lock:
+            lines = [f"# TYPE {p}_stage_seconds_total counter"]
+            lines += [f'{p}_stage_seconds_total{{stage="{n}"}} {v}' for n, v in self.stage_seconds.items()]
+            lines += [f"# TYPE {p}_stage_calls_total counter"]
+            lines += [f'{p}_stage_calls_total{{stage="{n}"}} {v}' for n, v in self.stage_calls.items()]
+            lines += [f"# TYPE {p}_stage_vram_peak_bytes gauge"]
+            lines += [f'{p}_stage_vram_peak_bytes{{stage="{n}"}} {v}' for n, v in self.stage_vram_peak.items()]
+            lines += [
+                f"# TYPE {p}_steps_total counter",
+                f"{p}_steps_total {self.steps}",
+                f"# TYPE {p}_step_seconds_total counter",
+                f"{p}_step_seconds_total {self.step_seconds}",
+            ]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,90 @@
+# =====================================
+# Latent previews
+# =====================================
+import torch
+import numpy as np
+from PIL import Image
+from ..logging.logging_setup import logger
+
+# Linear approximation of the VAE decoder, from the denoised latents to RGB in [-1, 1]
+LATENT_RGB_FACTORS = {
+    "sd1.5": [
+        [0.3512, 0.2297, 0.3227],
+        [0.3250, 0.4974, 0.2350],
+        [-0.2829, 0.1762, 0.2721],
+        [-0.2120, -0.2616, -0.7177],
+    ],
+    "sdxl": [
+        [0.3651, 0.4232, 0.4341],
+        [-0.2533, -0.0042, 0.1068],
+        [0.1076, 0.1111, -0.0362],
+        [-0.3165, -0.2492, -0.2188],
+    ],
+}
+LATENT_RGB_BIAS = {
+    "sd1.5": None,
+    "sdxl": [0.1084, -0.0175, -0.0011],
+}
+TAESD_MODEL_IDS = {
+    "sd1.5": "madebyollin/taesd",
+    "sdxl": "madebyollin/taesdxl",
+}
+PREVIEW_METHODS = ["linear", "taesd", "vae"]
+
+
+class LatentPreviewer:
+    """
+    Converts the latents of a denoising step into small preview images.
+
+    Methods:
+        linear: a per-pixel projection of the latent channels, practically free, 1/8 of the image size.
+        taesd: the tiny TAESD decoder, full size for a fraction of the VAE cost.
+        vae: the full VAE decode of the pipe.
+    """
+
+    def __init__(self, method="linear", model_type="sd1.5"):
+        if method not in PREVIEW_METHODS:
+            raise ValueError(f"Invalid preview method: {method}. Valid options are {PREVIEW_METHODS}")
+        self.method = method
+        self.model_type = model_type
+        self.taesd = None
+
+    def to_rgb(self, latents, vae=None):
+        """Returns the previews of `latents` as a float tensor (batch, 3, height, width) in [0, 1]."""
+        if self.method == "linear":
+            factors = torch.tensor(LATENT_RGB_FACTORS[self.model_type], device=latents.device)
+            rgb = torch.einsum("bchw,cr->brhw", latents.float(), factors)
+            if LATENT_RGB_BIAS[self.model_type] is not None:
+                bias = torch.tensor(LATENT_RGB_BIAS[self.model_type], device=latents.device)
+                rgb += bias[None, :, None, None]
+        elif self.method == "taesd":
+            if self.taesd is None:
+                from diffusers import AutoencoderTiny
+
+                repo_id = TAESD_MODEL_IDS[self.model_type]
+                logger.debug(f"Loading preview decoder: {repo_id}")
+                self.taesd = AutoencoderTiny.from_pretrained(repo_id, torch_dtype=latents.dtype)
+            self.taesd.to(latents.device)
+            rgb = self.taesd.decode(latents.to(self.taesd.dtype)).sample.float()
+        else:
+            rgb = vae.decode(latents.to(vae.dtype) / vae.config.scaling_factor).sample.float()
+
+        return (rgb / 2 + 0.5).clamp(0, 1)
+
+    @torch.no_grad()
+    def decode(self, latents, vae=None):
+        """Returns the previews of `latents` as PIL images."""
+        rgb = self.to_rgb(latents, vae)
+        array = (rgb.permute(0, 2, 3, 1).cpu().numpy() * 255).round().astype(np.uint8)
+        return [Image.fromarray(img) for img in array]
+
+    def step_callback(self, preview_callback, interval=1, vae=None):
+        """
+        Step callback that sends `preview_callback(step, images)` the previews
+        of every `interval` denoising steps.
+        """
+        def callback(step, timestep, latents):
+            if (step + 1) % interval == 0:
+                preview_callback(step, self.decode(latents, vae))
+
+        return callback
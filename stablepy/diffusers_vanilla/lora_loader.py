@@ -1,101 +1,487 @@
 # =====================================
 # LoRA Loaders
 # =====================================
+import os
 import torch
 from safetensors.torch import load_file
-from collections import defaultdict
+from collections import defaultdict, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import weakref
+from contextlib import contextmanager
+from .mmap_loader import mmap_safetensors
 from ..logging.logging_setup import logger
 
-def load_lora_weights(pipeline, checkpoint_path, multiplier, device, dtype):
-    LORA_PREFIX_UNET = "lora_unet"
-    LORA_PREFIX_TEXT_ENCODER = "lora_te"
-    # load LoRA weight from .safetensors
-    if isinstance(checkpoint_path, str):
-        checkpoint_path = [checkpoint_path]
-    for ckptpath in checkpoint_path:
-        state_dict = load_file(ckptpath, device=device)
-
-        updates = defaultdict(dict)
-        for key, value in state_dict.items():
-            # it is suggested to print out the key, it usually will be something like below
-            # "lora_te_text_model_encoder_layers_0_self_attn_k_proj.lora_down.weight"
-
-            layer, elem = key.split(".", 1)
-            updates[layer][elem] = value
-
-        # directly update weight in diffusers model
-        for layer, elems in updates.items():
-            if "text" in layer:
-                layer_infos = layer.split(LORA_PREFIX_TEXT_ENCODER + "_")[-1].split(
-                    "_"
-                )
-                curr_layer = pipeline.text_encoder
-            else:
-                layer_infos = layer.split(LORA_PREFIX_UNET + "_")[-1].split("_")
-                curr_layer = pipeline.unet
-
-            # find the target layer
-            temp_name = layer_infos.pop(0)
-            while len(layer_infos) > -1:
-                try:
-                    curr_layer = curr_layer.__getattr__(temp_name)
-                    if len(layer_infos) > 0:
-                        temp_name = layer_infos.pop(0)
-                    elif len(layer_infos) == 0:
-                        break
-                except Exception:
-                    if len(temp_name) > 0:
-                        temp_name += "_" + layer_infos.pop(0)
-                    else:
-                        temp_name = layer_infos.pop(0)
-
-            # get elements for this layer
-            weight_up = elems["lora_up.weight"].to(dtype)
-            weight_down = elems["lora_down.weight"].to(dtype)
-            alpha = elems["alpha"]
-            if alpha:
-                alpha = alpha.item() / weight_up.shape[1]
-            else:
-                alpha = 1.0
-
-            # update weight
-            if len(weight_up.shape) == 4:
-                curr_layer.weight.data += (
-                    multiplier
-                    * alpha
-                    * torch.mm(
-                        weight_up.squeeze(3).squeeze(2),
-                        weight_down.squeeze(3).squeeze(2),
-                    )
-                    .unsqueeze(2)
-                    .unsqueeze(3)
-                )
-            else:
-                curr_layer.weight.data += (
-                    multiplier * alpha * torch.mm(weight_up, weight_down)
-                )
+LORA_PREFIXES = {
+    "lora_unet": "unet",
+    "lora_te": "text_encoder",
+    "lora_te1": "text_encoder",
+    "lora_te2": "text_encoder_2",
+}
+LORA_READ_WORKERS = min(8, os.cpu_count() or 1)
+LORA_DELTA_BATCH = 32
 
-    logger.debug(f"Config LoRA: multiplier {multiplier} | alpha {alpha}")
 
-    return pipeline
+_module_name_index = weakref.WeakKeyDictionary()
 
 
-def lora_mix_load(pipe, lora_path, alpha_scale=1.0, device="cuda", dtype=torch.float16):
-    if hasattr(pipe, "text_encoder_2"):
-        # sdxl lora
-        pipe.load_lora_weights(lora_path)
-        pipe.fuse_lora(lora_scale=alpha_scale)
-        pipe.unload_lora_weights()
+def module_name_index(model):
+    """{flattened name: module} of the layers with weights of a model, built once per model instance."""
+    index = _module_name_index.get(model)
+    if index is None:
+        index = {
+            name.replace(".", "_"): module
+            for name, module in model.named_modules()
+            if name and isinstance(getattr(module, "weight", None), torch.Tensor)
+        }
+        _module_name_index[model] = index
+    return index
+
+
+def lora_layer_indexes(pipeline):
+    """{kohya prefix: module name index} of the UNet and text encoders of a pipeline."""
+    indexes = {}
+    for prefix, component_name in LORA_PREFIXES.items():
+        component = getattr(pipeline, component_name, None)
+        if component is not None:
+            indexes[prefix] = module_name_index(component)
+    return indexes
+
+
+def find_lora_layer(indexes, layer):
+    """The module of a kohya layer name like `lora_unet_down_blocks_0_attentions_0_...`, None if unknown."""
+    prefix, _, name = layer.partition("_")
+    component_prefix, _, name = name.partition("_")
+    index = indexes.get(f"{prefix}_{component_prefix}")
+    return index.get(name) if index is not None else None
+
+
+def resolve_lora_layers(indexes, layers):
+    """
+    {layer: module} for the kohya layer names, raising with every unknown layer
+    before any weight is read.
+    """
+    modules = {layer: find_lora_layer(indexes, layer) for layer in layers}
+    unknown = [layer for layer, module in modules.items() if module is None]
+    if unknown:
+        raise ValueError(
+            f"{len(unknown)} of {len(modules)} LoRA layers not found in the model: "
+            f"{', '.join(unknown[:5])}{', ...' if len(unknown) > 5 else ''}"
+        )
+    return modules
+
+
+# =====================================
+# LoRA manager
+# =====================================
+FusedLora = namedtuple("FusedLora", ["path", "scale", "factors"])
+
+
+def lora_delta(weight, up, down, alpha):
+    """up @ down in the shape of the weight, for linear and conv layers."""
+    up = up.to(device=weight.device, dtype=weight.dtype)
+    down = down.to(device=weight.device, dtype=weight.dtype)
+    return torch.mm(up.flatten(1), down.flatten(1)).reshape(weight.shape) * alpha
+
+
+def _read_factors(layers, dtype):
+    # copies the memory-mapped tensors, the pages are read here
+    return [
+        (module, elems["lora_up.weight"].to(dtype, copy=True), elems["lora_down.weight"].to(dtype, copy=True), elems.get("alpha"))
+        for module, elems in layers
+    ]
+
+
+def kohya_lora_factors(pipeline, checkpoint_path, dtype, indexes=None):
+    """
+    {module: (up, down, alpha)} of a LoRA in the kohya format. The file is memory-mapped
+    and its tensors are copied on a thread pool, so reading a large LoRA is I/O-bound.
+    """
+    if indexes is None:
+        indexes = lora_layer_indexes(pipeline)
+    state_dict = mmap_safetensors(checkpoint_path)
+
+    updates = defaultdict(dict)
+    for key, value in state_dict.items():
+        layer, elem = key.split(".", 1)
+        updates[layer][elem] = value
+
+    modules = resolve_lora_layers(indexes, updates)
+    layers = []
+    for layer, elems in updates.items():
+        if "lora_up.weight" not in elems or "lora_down.weight" not in elems:
+            raise ValueError(f"Not a LoRA layer: {layer} {list(elems)}")
+        layers.append((modules[layer], elems))
+
+    chunks = [layers[i:i + LORA_DELTA_BATCH] for i in range(0, len(layers), LORA_DELTA_BATCH)]
+    if len(chunks) > 1:
+        with ThreadPoolExecutor(max_workers=LORA_READ_WORKERS) as executor:
+            results = list(executor.map(lambda chunk: _read_factors(chunk, dtype), chunks))
+    else:
+        results = [_read_factors(chunk, dtype) for chunk in chunks]
+
+    factors = {}
+    for module, weight_up, weight_down, alpha in (f for result in results for f in result):
+        if alpha:
+            alpha = alpha.item() / weight_up.shape[1]
+        else:
+            alpha = 1.0
+        factors[module] = (weight_up, weight_down, alpha)
+
+    return factors
+
+
+def lora_deltas(modules, factors):
+    """
+    Yields (module, up @ down * alpha) for the modules, computed with one batched
+    matmul for each group of layers with the same shapes, device and dtype.
+    """
+    groups = defaultdict(list)
+    for module in modules:
+        up, down, _ = factors[module]
+        weight = module.weight
+        groups[(up.shape, down.shape, weight.shape, weight.device, weight.dtype)].append(module)
+
+    for (_, _, shape, device, dtype), group in groups.items():
+        for i in range(0, len(group), LORA_DELTA_BATCH):
+            batch = group[i:i + LORA_DELTA_BATCH]
+            if len(batch) == 1:
+                module = batch[0]
+                yield module, lora_delta(module.weight, *factors[module])
+                continue
+            ups = torch.stack([factors[m][0].flatten(1) for m in batch]).to(device=device, dtype=dtype)
+            downs = torch.stack([factors[m][1].flatten(1) for m in batch]).to(device=device, dtype=dtype)
+            alphas = torch.tensor([factors[m][2] for m in batch], device=device, dtype=dtype)
+            deltas = torch.bmm(ups, downs) * alphas.view(-1, 1, 1)
+            for module, delta in zip(batch, deltas):
+                yield module, delta.reshape(shape)
+
+
+def diffusers_lora_factors(pipe, lora_path, adapter_name):
+    """
+    {module: (up, down, alpha)} of any LoRA format supported by diffusers, read
+    from the PEFT layers it creates, which are removed afterwards.
+    """
+    from peft.tuners.tuners_utils import BaseTunerLayer
+
+    if os.path.isfile(lora_path) and lora_path.endswith(".safetensors"):
+        pipe.load_lora_weights(load_file(lora_path), adapter_name=adapter_name)
     else:
-        # sd lora
+        pipe.load_lora_weights(lora_path, adapter_name=adapter_name)
+    try:
+        factors = {}
+        components = [getattr(pipe, name, None) for name in ("unet", "text_encoder", "text_encoder_2")]
+        for component in components:
+            if component is None:
+                continue
+            for module in component.modules():
+                if not isinstance(module, BaseTunerLayer) or adapter_name not in getattr(module, "lora_A", {}):
+                    continue
+                if getattr(module, "use_dora", {}).get(adapter_name, False):
+                    raise ValueError("DoRA is not supported")
+                factors[module.get_base_layer()] = (
+                    module.lora_B[adapter_name].weight.detach().to("cpu", copy=True),
+                    module.lora_A[adapter_name].weight.detach().to("cpu", copy=True),
+                    module.scaling[adapter_name],
+                )
+    finally:
+        pipe.unload_lora_weights()
+        for component in components:
+            if component is not None:
+                # PEFT may have swapped modules, the name index is built again
+                _module_name_index.pop(component, None)
+
+    if not factors:
+        raise ValueError(f"No LoRA layers found in {lora_path}")
+    return factors
+
+
+def runtime_factors(module, up, down, alpha):
+    """The factors of a layer reshaped for `lora_side_output`, on the device and dtype of the layer."""
+    weight = module.weight
+    up = up.to(device=weight.device, dtype=weight.dtype)
+    down = down.to(device=weight.device, dtype=weight.dtype)
+    rank = down.shape[0]
+    if isinstance(module, torch.nn.Conv2d):
+        if module.groups != 1:
+            raise ValueError("Grouped convolutions are not supported for unfused LoRAs")
+        return up.reshape(weight.shape[0], rank, 1, 1), down.reshape(rank, *weight.shape[1:]), alpha
+    if isinstance(module, torch.nn.Linear):
+        return up.reshape(weight.shape[0], rank), down.reshape(rank, weight.shape[1]), alpha
+    raise ValueError(f"Unfused LoRAs are not supported for {type(module).__name__} layers")
+
+
+def lora_side_output(module, x, up, down):
+    """up(down(x)), the low-rank path of a LoRA next to a linear or conv layer."""
+    if isinstance(module, torch.nn.Conv2d):
+        hidden = torch.nn.functional.conv2d(
+            x, down, stride=module.stride, padding=module.padding, dilation=module.dilation
+        )
+        return torch.nn.functional.conv2d(hidden, up)
+    return torch.nn.functional.linear(torch.nn.functional.linear(x, down), up)
+
+
+class LoraManager:
+    """
+    Fuses LoRAs into the weights of a pipeline. The original weights of the layers
+    changed by a LoRA are kept on the CPU, unloading a LoRA restores them exactly and
+    adds back the other LoRAs of those layers, without reading any file. The factors
+    of the last LoRAs used are cached on the CPU, so loading them again doesn't read
+    the file.
+
+    With `fuse=False` the weights are never changed, the LoRAs are applied at
+    forward time as low-rank side paths of their layers through forward hooks.
+    Loading, unloading or rescaling a LoRA only changes which LoRAs the hooks
+    use, the factors stay on the device for the last `cache_size` LoRAs.
+    """
+
+    def __init__(self, cache_size=8, fuse=True):
+        self.cache_size = cache_size
+        self.fuse = fuse
+        self.factors_cache = OrderedDict()
+        self.runtime_cache = OrderedDict()
+        self.loaded = []
+        self.originals = {}
+        self.module_loras = defaultdict(list)
+        self.hooks = {}
+        self.pinned = set()
+        self._adapter_count = 0
+
+    @staticmethod
+    def cache_key(lora_path):
+        if os.path.isfile(lora_path):
+            stat = os.stat(lora_path)
+            return (os.path.realpath(lora_path), stat.st_size, stat.st_mtime_ns)
+        return lora_path
+
+    def _evict(self, cache):
+        # least recently used first, the pinned LoRAs are never evicted
+        unpinned = [key for key in cache if key not in self.pinned]
+        for key in unpinned[:max(0, len(unpinned) - self.cache_size)]:
+            del cache[key]
+
+    def _cache_factors(self, key, factors):
+        self.factors_cache[key] = factors
+        self._evict(self.factors_cache)
+
+    def pin(self, pipe, lora_path, dtype=torch.float16):
+        """
+        Reads the factors of a LoRA and keeps them cached for the life of the manager,
+        in page-locked memory with CUDA so moving them to the GPU is fast. Loading and
+        unloading a pinned LoRA never reads the file or the Hub again.
+        """
+        key = self.cache_key(lora_path)
+        if key in self.pinned:
+            return
+        # pinned first, so get_factors doesn't evict it with a small cache_size
+        self.pinned.add(key)
+        try:
+            factors = self.get_factors(pipe, lora_path, dtype)
+        except Exception:
+            self.pinned.discard(key)
+            raise
+        if torch.cuda.is_available():
+            factors = {
+                module: (up.pin_memory(), down.pin_memory(), alpha)
+                for module, (up, down, alpha) in factors.items()
+            }
+        self.factors_cache[key] = factors
+
+    def prefetch(self, pipe, lora_paths, dtype=torch.float16):
+        """
+        Reads the kohya LoRA files of `lora_paths` that aren't cached in parallel.
+        The other formats are left to `get_factors`, they modify the pipeline.
+        """
+        paths = [
+            path for path in dict.fromkeys(lora_paths)
+            if os.path.isfile(path) and path.endswith(".safetensors") and self.cache_key(path) not in self.factors_cache
+        ][:self.cache_size]
+        if len(paths) < 2:
+            return
+
+        indexes = lora_layer_indexes(pipe)
+
+        def read(path):
+            try:
+                return kohya_lora_factors(pipe, path, dtype, indexes)
+            except Exception as e:
+                logger.debug(f"{path}: {str(e)}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(len(paths), LORA_READ_WORKERS)) as executor:
+            results = list(executor.map(read, paths))
+
+        for path, factors in zip(paths, results):
+            if factors is not None:
+                self._cache_factors(self.cache_key(path), factors)
+
+    def get_factors(self, pipe, lora_path, dtype):
+        key = self.cache_key(lora_path)
+        factors = self.factors_cache.get(key)
+        if factors is not None:
+            self.factors_cache.move_to_end(key)
+            return factors
+
+        factors = None
+        if os.path.isfile(lora_path) and lora_path.endswith(".safetensors"):
+            # kohya lora, other layouts raise on the first unknown layer
+            try:
+                factors = kohya_lora_factors(pipe, lora_path, dtype)
+            except Exception as e:
+                logger.debug(f"{str(e)} \nDiffusers loader>>")
+        if factors is None:
+            self._adapter_count += 1
+            factors = diffusers_lora_factors(pipe, lora_path, f"stablepy_lora_{self._adapter_count}")
+
+        self._cache_factors(key, factors)
+        return factors
+
+    def get_runtime_factors(self, pipe, lora_path, dtype):
+        key = self.cache_key(lora_path)
+        factors = self.runtime_cache.get(key)
+        if factors is not None:
+            self.runtime_cache.move_to_end(key)
+            return factors
+
+        factors = {
+            module: runtime_factors(module, *layer_factors)
+            for module, layer_factors in self.get_factors(pipe, lora_path, dtype).items()
+        }
+        self.runtime_cache[key] = factors
+        self._evict(self.runtime_cache)
+        return factors
+
+    def forward_hook(self, module, inputs, output):
+        x = inputs[0]
+        for fused in self.module_loras.get(module, ()):
+            up, down, alpha = fused.factors[module]
+            scale = fused.scale
+            if isinstance(scale, torch.Tensor):
+                # one scale per batch row, the rows are repeated for classifier-free guidance
+                scale = scale.to(device=output.device, dtype=output.dtype)
+                scale = scale.repeat(output.shape[0] // scale.shape[0]).view(-1, *[1] * (output.dim() - 1))
+            output = output + (scale * alpha) * lora_side_output(module, x, up, down)
+        return output
+
+    def _add_unfused(self, fused):
+        for module in fused.factors:
+            if module not in self.hooks:
+                self.hooks[module] = module.register_forward_hook(self.forward_hook)
+            self.module_loras[module].append(fused)
+
+    def _remove_unfused(self, fused):
+        for module in fused.factors:
+            others = [f for f in self.module_loras[module] if f is not fused]
+            if others:
+                self.module_loras[module] = others
+            else:
+                del self.module_loras[module]
+                self.hooks.pop(module).remove()
+
+    @contextmanager
+    def row_loras(self, pipe, rows, dtype=torch.float16):
+        """
+        Applies a different set of LoRAs to each batch row within the context, `rows`
+        holds the [(path, scale), ...] of each row. Only with `fuse=False`, the LoRAs
+        loaded before still apply to every row.
+        """
+        row_scales = {}
+        for i, row in enumerate(rows):
+            for lora_path, scale in row:
+                if lora_path is not None:
+                    row_scales.setdefault(lora_path, [0.0] * len(rows))[i] += scale
+        if row_scales and self.fuse:
+            raise ValueError("LoRAs per batch row need the unfused mode")
+
+        added = []
         try:
-            pipe = load_lora_weights(
-                pipe, [lora_path], alpha_scale, device=device, dtype=dtype
-            )
-        except Exception as e:
-            logger.debug(f"{str(e)} \nDiffusers loader>>")
-            pipe.load_lora_weights(lora_path)
-            pipe.fuse_lora(lora_scale=alpha_scale)
-            pipe.unload_lora_weights()
-
-    return pipe
+            for lora_path, scales in row_scales.items():
+                fused = FusedLora(lora_path, torch.tensor(scales), self.get_runtime_factors(pipe, lora_path, dtype))
+                self._add_unfused(fused)
+                added.append(fused)
+            yield
+        finally:
+            for fused in added:
+                self._remove_unfused(fused)
+
+    def load(self, pipe, lora_path, scale=1.0, dtype=torch.float16):
+        if not self.fuse:
+            factors = self.get_runtime_factors(pipe, lora_path, dtype)
+            fused = FusedLora(lora_path, scale, factors)
+            self._add_unfused(fused)
+            self.loaded.append(fused)
+            logger.debug(f"Unfused LoRA: {lora_path} | scale {scale} | {len(factors)} layers")
+            return fused
+
+        factors = self.get_factors(pipe, lora_path, dtype)
+        fused = FusedLora(lora_path, scale, factors)
+
+        with torch.no_grad():
+            for module, delta in lora_deltas(factors, factors):
+                if module not in self.originals:
+                    self.originals[module] = module.weight.data.to("cpu", copy=True)
+                module.weight.data += scale * delta
+                self.module_loras[module].append(fused)
+
+        self.loaded.append(fused)
+        logger.debug(f"Config LoRA: {lora_path} | scale {scale} | {len(factors)} layers")
+        return fused
+
+    def find(self, lora_path, scale=None):
+        fused = next(
+            (f for f in self.loaded if f.path == lora_path and (scale is None or f.scale == scale)),
+            None,
+        )
+        if fused is None:
+            raise ValueError(f"LoRA not loaded: {lora_path}")
+        return fused
+
+    def set_scale(self, pipe, lora_path, scale, previous_scale=None):
+        """Changes the scale of a loaded LoRA by adding (scale - previous scale) * delta."""
+        fused = self.find(lora_path, previous_scale)
+        rescaled = fused._replace(scale=scale)
+        self.loaded = [rescaled if f is fused else f for f in self.loaded]
+
+        with torch.no_grad():
+            for module in fused.factors:
+                self.module_loras[module] = [rescaled if f is fused else f for f in self.module_loras[module]]
+            if self.fuse:
+                for module, delta in lora_deltas(fused.factors, fused.factors):
+                    module.weight.data += (scale - fused.scale) * delta
+
+        logger.debug(f"Rescale LoRA: {lora_path} | {fused.scale} -> {scale}")
+        return rescaled
+
+    def unload(self, pipe, lora_path, scale=None):
+        fused = self.find(lora_path, scale)
+        self.loaded = [f for f in self.loaded if f is not fused]
+
+        if not self.fuse:
+            self._remove_unfused(fused)
+            return
+
+        with torch.no_grad():
+            for module in fused.factors:
+                module.weight.data.copy_(self.originals[module])
+                others = [f for f in self.module_loras[module] if f is not fused]
+                if others:
+                    self.module_loras[module] = others
+                else:
+                    del self.module_loras[module]
+                    del self.originals[module]
+
+            # adds back the other LoRAs of the restored layers, in loading order
+            for other in self.loaded:
+                shared = [module for module in fused.factors if module in other.factors]
+                for module, delta in lora_deltas(shared, other.factors):
+                    module.weight.data += other.scale * delta
+
+    def unload_all(self, pipe):
+        for hook in self.hooks.values():
+            hook.remove()
+        self.hooks = {}
+        with torch.no_grad():
+            for module, original in self.originals.items():
+                module.weight.data.copy_(original)
+        self.loaded = []
+        self.originals = {}
+        self.module_loras = defaultdict(list)
@@ -0,0 +1,171 @@
+# =====================================
+# Memory-mapped weights
+# =====================================
+import os
+import json
+import mmap
+import struct
+import shutil
+import hashlib
+import importlib
+import torch
+from ..logging.logging_setup import logger
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def mmap_safetensors(path):
+    """
+    Returns the tensors of a .safetensors file as CPU tensors backed by a
+    copy-on-write memory map of the file. Nothing is read until a tensor is
+    used, and processes mapping the same file share its pages in the page cache.
+    """
+    with open(path, "rb") as f:
+        header_len = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_len))
+        # ACCESS_COPY: in-place updates (e.g. fused LoRAs) never reach the file
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_len
+    tensors = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if end == start:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        itemsize = torch.tensor([], dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(
+            buffer,
+            dtype=dtype,
+            count=(end - start) // itemsize,
+            offset=data_start + start,
+        ).reshape(info["shape"])
+
+    return tensors
+
+
+def weights_cache_key(base_model_id, torch_dtype):
+    """Cache folder name for a checkpoint file, a local folder or a Hub repo in a given precision."""
+    if os.path.isfile(base_model_id):
+        stat = os.stat(base_model_id)
+        source = f"{os.path.realpath(base_model_id)}|{stat.st_size}|{stat.st_mtime_ns}"
+        name = os.path.splitext(os.path.basename(base_model_id))[0]
+    elif os.path.isdir(base_model_id):
+        # a folder replaced or updated in place changes the size or mtime of its files
+        source = os.path.realpath(base_model_id)
+        for path in _model_folder_files(base_model_id):
+            stat = os.stat(path)
+            source += f"|{os.path.relpath(path, base_model_id)}|{stat.st_size}|{stat.st_mtime_ns}"
+        name = os.path.basename(os.path.normpath(base_model_id))
+    else:
+        source = base_model_id
+        name = base_model_id.replace("/", "--")
+    source += f"|{str(torch_dtype)}"
+    return f"{name}-{hashlib.sha1(source.encode()).hexdigest()[:12]}"
+
+
+def _component_weight_files(folder):
+    return sorted(
+        os.path.join(folder, f) for f in os.listdir(folder) if f.endswith(".safetensors")
+    )
+
+
+def _model_folder_files(model_dir):
+    # model_index.json and the weight files of the components of a diffusers folder
+    files = [os.path.join(model_dir, "model_index.json")]
+    for entry in sorted(os.listdir(model_dir)):
+        folder = os.path.join(model_dir, entry)
+        if os.path.isdir(folder):
+            files += sorted(
+                os.path.join(folder, f) for f in os.listdir(folder) if f.endswith((".safetensors", ".bin"))
+            )
+    return files
+
+
+def load_pipeline_mmap(pipeline_class, model_dir):
+    """
+    Builds a pipeline from a diffusers-format folder with every model component
+    created on the meta device and its parameters assigned from memory-mapped
+    .safetensors files, so no weights are copied into process memory.
+    """
+    from accelerate import init_empty_weights
+
+    with open(os.path.join(model_dir, "model_index.json"), "r") as json_config:
+        model_index = json.load(json_config)
+
+    components = {}
+    for name, value in model_index.items():
+        if name.startswith("_") or not isinstance(value, list):
+            continue
+        library_name, class_name = value
+        folder = os.path.join(model_dir, name)
+        if library_name is None or not os.path.isdir(folder):
+            continue
+
+        weight_files = _component_weight_files(folder)
+        if not weight_files:
+            # tokenizers, schedulers and feature extractors
+            continue
+
+        component_class = getattr(importlib.import_module(library_name), class_name)
+        with init_empty_weights():
+            if hasattr(component_class, "load_config"):
+                # diffusers model
+                module = component_class.from_config(component_class.load_config(folder))
+            else:
+                # transformers model
+                config = component_class.config_class.from_pretrained(folder)
+                module = component_class._from_config(config)
+
+        state_dict = {}
+        for weight_file in weight_files:
+            state_dict.update(mmap_safetensors(weight_file))
+        module.load_state_dict(state_dict, strict=False, assign=True)
+
+        missing = [n for n, p in module.named_parameters() if p.device.type == "meta"]
+        if missing:
+            raise ValueError(f"Missing weights for {name} in {folder}: {missing[:5]}")
+
+        module.eval()
+        components[name] = module
+        logger.debug(f"Memory-mapped {name} from {len(weight_files)} file(s)")
+
+    return pipeline_class.from_pretrained(model_dir, **components)
+
+
+def load_pipe_mmap(pipeline_class, base_model_id, cache_dir, torch_dtype, build_pipe):
+    """
+    Loads `base_model_id` with memory-mapped weights. The first load calls
+    `build_pipe()` and saves the result in diffusers format inside `cache_dir`;
+    afterwards every process on the host maps the same cached files.
+    """
+    model_dir = os.path.join(cache_dir, weights_cache_key(base_model_id, torch_dtype))
+
+    if not os.path.isfile(os.path.join(model_dir, "model_index.json")):
+        logger.info(f"Creating memory-mapped weights cache: {model_dir}")
+        pipe = build_pipe()
+        tmp_dir = f"{model_dir}.tmp{os.getpid()}"
+        pipe.save_pretrained(tmp_dir, safe_serialization=True)
+        del pipe
+        try:
+            os.rename(tmp_dir, model_dir)
+        except OSError:
+            # another process finished the same cache first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    logger.debug(f"Memory-mapped weights: {model_dir}")
+    return load_pipeline_mmap(pipeline_class, model_dir)
@@ -59,13 +59,20 @@ from .constants import (
 )
 from .multi_emphasis_prompt import long_prompts_with_weighting
 from diffusers.utils import load_image
-from .prompt_weights import get_embed_new, add_comma_after_pattern_ti
-from .utils import save_pil_image_with_metadata, checkpoint_model_type
-from .lora_loader import lora_mix_load
+from .prompt_weights import get_embed_new, add_comma_after_pattern_ti, maybe_convert_prompt
+from .utils import save_pil_image_with_metadata, checkpoint_model_type, step_callback_kwargs
+from .lora_loader import LoraManager
+from .textual_inversion import TextualInversionManager
+from .mmap_loader import load_pipe_mmap
+from .timesteps_cache import cache_timesteps, copy_scheduler
+from .cancellation import CancellationToken, GenerationCancelled, release_on_cancel
+from .latent_preview import LatentPreviewer
+from .instrumentation import GenerationProfiler, ends_open_stages
+from .tracing import traced, traces_generation
 from .inpainting_canvas import draw, make_inpaint_condition
 from .adetailer import ad_model_process
 from ..logging.logging_setup import logger
-from .extra_model_loaders import custom_task_model_loader
+from .extra_model_loaders import custom_task_model_loader, share_components, release_controlnet
 from .high_resolution import process_images_high_resolution
 from .style_prompt_config import (
     styles_data,
@@ -81,15 +88,19 @@ from PIL import Image
 from typing import Union, Optional, List, Tuple, Dict, Any, Callable # noqa
 import logging
 import diffusers
-import copy
 import warnings
 import traceback
+from collections import namedtuple
 logging.getLogger("diffusers").setLevel(logging.ERROR)
 logging.getLogger("transformers").setLevel(logging.ERROR)
 diffusers.utils.logging.set_verbosity(40)
 warnings.filterwarnings(action="ignore", category=FutureWarning, module="diffusers")
 warnings.filterwarnings(action="ignore", category=FutureWarning, module="transformers")
 
+GenerationResult = namedtuple(
+    "GenerationResult", ["images", "seeds", "image_paths", "timings", "stages"]
+)
+
 # =====================================
 # Utils preprocessor
 # =====================================
@@ -285,6 +296,9 @@ class Model_Diffusers:
         vae_model=None,
         type_model_precision=torch.float16,
         retain_task_model_in_cache=True,
+        memory_map_weights=False,
+        weights_cache_dir="./weights_cache",
+        fuse_loras=True,
     ):
         self.device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
         self.base_model_id = ""
@@ -293,6 +307,11 @@ class Model_Diffusers:
         self.type_model_precision = (
             type_model_precision if torch.cuda.is_available() else torch.float32
         )  # For SD 1.5
+        # Keep the weights as mmap-backed tensors shared through the page cache
+        self.memory_map_weights = memory_map_weights
+        self.weights_cache_dir = weights_cache_dir
+        # False: the LoRAs are applied at forward time, switching them doesn't touch the weights
+        self.fuse_loras = fuse_loras
 
         self.load_pipe(
             base_model_id,
@@ -310,6 +329,10 @@ class Model_Diffusers:
         self.image_encoder_name = None
         self.image_encoder_module = None
 
+        self.latent_previewer = None
+        self.preview_handle = None
+
+    @traced("load_pipe")
     def load_pipe(
         self,
         base_model_id: str,
@@ -358,11 +381,13 @@ class Model_Diffusers:
             # Unload previous model and stuffs
             self.pipe = None
             self.model_memory = {}
-            self.lora_memory = [None, None, None, None, None]
-            self.lora_scale_memory = [1.0, 1.0, 1.0, 1.0, 1.0]
+            self.lora_memory = {}
+            self.lora_manager = LoraManager(fuse=self.fuse_loras)
+            self.flash_lora_failures = set()
             self.flash_config = None
             self.ip_adapter_config = None
             self.embed_loaded = []
+            self.textual_inversion_manager = TextualInversionManager()
             self.FreeU = False
             torch.cuda.empty_cache()
             gc.collect()
@@ -378,70 +403,116 @@ class Model_Diffusers:
 
                 if model_type == "sdxl":
                     logger.info("Default VAE: madebyollin/sdxl-vae-fp16-fix")
-                    self.pipe = StableDiffusionXLPipeline.from_single_file(
-                        base_model_id,
-                        vae=AutoencoderKL.from_pretrained(
-                            "madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16
-                        ),
-                        torch_dtype=self.type_model_precision,
-                    )
+
+                    def build_pipe():
+                        return StableDiffusionXLPipeline.from_single_file(
+                            base_model_id,
+                            vae=AutoencoderKL.from_pretrained(
+                                "madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16
+                            ),
+                            torch_dtype=self.type_model_precision,
+                        )
                     class_name = "StableDiffusionXLPipeline"
                 elif model_type == "sd1.5":
-                    self.pipe = StableDiffusionPipeline.from_single_file(
-                        base_model_id,
-                        # vae=None
-                        # if vae_model == None
-                        # else AutoencoderKL.from_single_file(
-                        #     vae_model
-                        # ),
-                        torch_dtype=self.type_model_precision,
-                    )
+                    def build_pipe():
+                        return StableDiffusionPipeline.from_single_file(
+                            base_model_id,
+                            # vae=None
+                            # if vae_model == None
+                            # else AutoencoderKL.from_single_file(
+                            #     vae_model
+                            # ),
+                            torch_dtype=self.type_model_precision,
+                        )
                     class_name = "StableDiffusionPipeline"
                 else:
                     raise ValueError(f"Model type {model_type} not supported.")
+
+                if self.memory_map_weights:
+                    self.pipe = load_pipe_mmap(
+                        getattr(diffusers, class_name),
+                        base_model_id,
+                        self.weights_cache_dir,
+                        self.type_model_precision,
+                        build_pipe,
+                    )
+                else:
+                    self.pipe = build_pipe()
             else:
-                file_config = hf_hub_download(repo_id=base_model_id, filename="model_index.json")
+                if os.path.isdir(base_model_id):
+                    # Local folder in diffusers format
+                    file_config = os.path.join(base_model_id, "model_index.json")
+                else:
+                    file_config = hf_hub_download(repo_id=base_model_id, filename="model_index.json")
 
                 # Reading data from the JSON file
                 with open(file_config, 'r') as json_config:
                     data_config = json.load(json_config)
 
                 # Searching for the value of the "_class_name" key
-                if '_class_name' in data_config:
-                    class_name = data_config['_class_name']
-
-                match class_name:
-                    case "StableDiffusionPipeline":
-                        self.pipe = StableDiffusionPipeline.from_pretrained(
-                            base_model_id,
-                            torch_dtype=self.type_model_precision,
-                        )
+                class_name = data_config.get('_class_name', "")
 
-                    case "StableDiffusionXLPipeline":
-                        logger.info("Default VAE: madebyollin/sdxl-vae-fp16-fix")
-                        try:
-                            self.pipe = DiffusionPipeline.from_pretrained(
+                def build_pipe():
+                    match class_name:
+                        case "StableDiffusionPipeline":
+                            return StableDiffusionPipeline.from_pretrained(
                                 base_model_id,
-                                vae=AutoencoderKL.from_pretrained(
-                                    "madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16
-                                ),
-                                torch_dtype=torch.float16,
-                                use_safetensors=True,
-                                variant="fp16",
-                                add_watermarker=False,
+                                torch_dtype=self.type_model_precision,
                             )
-                        except Exception as e:
-                            logger.debug(e)
-                            logger.debug("Loading model without parameter variant=fp16")
-                            self.pipe = DiffusionPipeline.from_pretrained(
+
+                        case "StableDiffusionXLPipeline" if os.path.isdir(base_model_id):
+                            # A local folder keeps its own VAE
+                            return StableDiffusionXLPipeline.from_pretrained(
                                 base_model_id,
-                                vae=AutoencoderKL.from_pretrained(
-                                    "madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16
-                                ),
-                                torch_dtype=torch.float16,
-                                use_safetensors=True,
+                                torch_dtype=self.type_model_precision,
                                 add_watermarker=False,
                             )
+
+                        case "StableDiffusionXLPipeline":
+                            logger.info("Default VAE: madebyollin/sdxl-vae-fp16-fix")
+                            try:
+                                return DiffusionPipeline.from_pretrained(
+                                    base_model_id,
+                                    vae=AutoencoderKL.from_pretrained(
+                                        "madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16
+                                    ),
+                                    torch_dtype=torch.float16,
+                                    use_safetensors=True,
+                                    variant="fp16",
+                                    add_watermarker=False,
+                                )
+                            except Exception as e:
+                                logger.debug(e)
+                                logger.debug("Loading model without parameter variant=fp16")
+                                return DiffusionPipeline.from_pretrained(
+                                    base_model_id,
+                                    vae=AutoencoderKL.from_pretrained(
+                                        "madebyollin/sdxl-vae-fp16-fix", torch_dtype=torch.float16
+                                    ),
+                                    torch_dtype=torch.float16,
+                                    use_safetensors=True,
+                                    add_watermarker=False,
+                                )
+
+                        case _:
+                            raise ValueError(f"Pipeline {class_name} of {base_model_id} not supported.")
+
+                if self.memory_map_weights:
+                    # the SDXL models of the Hub are always loaded in float16
+                    if class_name == "StableDiffusionXLPipeline" and not os.path.isdir(base_model_id):
+                        load_dtype = torch.float16
+                    else:
+                        load_dtype = self.type_model_precision
+                    self.pipe = load_pipe_mmap(
+                        # an unsupported class is reported by build_pipe
+                        getattr(diffusers, class_name, None),
+                        base_model_id,
+                        self.weights_cache_dir,
+                        load_dtype,
+                        build_pipe,
+                    )
+                else:
+                    self.pipe = build_pipe()
             self.base_model_id = base_model_id
             self.class_name = class_name
 
@@ -467,7 +538,10 @@ class Model_Diffusers:
             self.vae_model = vae_model
 
             # Define base scheduler
-            self.default_scheduler = copy.deepcopy(self.pipe.scheduler)
+            self.default_scheduler = copy_scheduler(self.pipe.scheduler)
+            # The schedulers and task pipelines of the previous base model
+            self.scheduler_cache = {}
+            self.task_model_cache = {}
             logger.debug(f"Base sampler: {self.default_scheduler}")
 
         if task_name in self.model_memory:
@@ -849,14 +923,48 @@ class Model_Diffusers:
         return init_image, control_mask, control_image
 
     def get_scheduler(self, name):
+        """
+        Returns a new scheduler for the sampler `name`. The schedulers are built once per base
+        model and each call gets a shallow copy; the state of a run (timesteps, sigmas, model
+        outputs) is reassigned by `set_timesteps`, so the copies never share it. The results of
+        `set_timesteps` are cached for the whole process, see `cache_timesteps`.
+        """
         if name in SCHEDULER_CONFIG_MAP:
-            scheduler_class, config = SCHEDULER_CONFIG_MAP[name]
-            # return scheduler_class.from_config(self.pipe.scheduler.config, **config)
-            # beta self.default_scheduler
-            return scheduler_class.from_config(self.default_scheduler.config, **config)
+            scheduler = self.scheduler_cache.get(name)
+            if scheduler is None:
+                scheduler_class, config = SCHEDULER_CONFIG_MAP[name]
+                # return scheduler_class.from_config(self.pipe.scheduler.config, **config)
+                # beta self.default_scheduler
+                scheduler = cache_timesteps(scheduler_class.from_config(self.default_scheduler.config, **config))
+                self.scheduler_cache[name] = scheduler
+            return copy_scheduler(scheduler)
         else:
             raise ValueError(f"Scheduler with name {name} not found. Valid schedulers: {', '.join(scheduler_names)}")
 
+    def get_task_model(self, model_category):
+        """
+        Returns the hires or detailfix pipeline of the current task. It is built once per
+        base model and task and shares the components of `self.pipe`, which are synced on
+        each call; the scheduler is the only state of a run it holds and is reassigned.
+        Its own weights (the SD 1.5 inpaint ControlNet) are freed by `release_task_models`.
+        """
+        key = (model_category, self.task_name)
+        task_pipe = self.task_model_cache.get(key)
+        if task_pipe is None:
+            task_pipe = custom_task_model_loader(
+                pipe=self.pipe,
+                model_category=model_category,
+                task_name=self.task_name,
+                torch_dtype=self.type_model_precision
+            )
+            self.task_model_cache[key] = task_pipe
+        return share_components(task_pipe, self.pipe, self.type_model_precision)
+
+    def release_task_models(self):
+        """Frees the weights of the task pipelines not shared with `self.pipe`."""
+        for task_pipe in self.task_model_cache.values():
+            release_controlnet(task_pipe)
+
     def emphasis_prompt(
         self,
         pipe,
@@ -870,8 +978,8 @@ class Model_Diffusers:
         if hasattr(pipe, "text_encoder_2"):
             # Prompt weights for textual inversion
             try:
-                prompt_ti = pipe.maybe_convert_prompt(prompt, pipe.tokenizer)
-                negative_prompt_ti = pipe.maybe_convert_prompt(negative_prompt, pipe.tokenizer)
+                prompt_ti = maybe_convert_prompt(pipe, prompt, pipe.tokenizer)
+                negative_prompt_ti = maybe_convert_prompt(pipe, negative_prompt, pipe.tokenizer)
             except Exception as e:
                 logger.debug(str(e))
                 prompt_ti = prompt
@@ -898,9 +1006,9 @@ class Model_Diffusers:
             return all_cond, all_pooled
         else:
             # Prompt weights for textual inversion
-            prompt_ti = self.pipe.maybe_convert_prompt(prompt, self.pipe.tokenizer)
-            negative_prompt_ti = self.pipe.maybe_convert_prompt(
-                negative_prompt, self.pipe.tokenizer
+            prompt_ti = maybe_convert_prompt(self.pipe, prompt, self.pipe.tokenizer)
+            negative_prompt_ti = maybe_convert_prompt(
+                self.pipe, negative_prompt, self.pipe.tokenizer
             )
 
             # separate the multi-vector textual inversion by comma
@@ -917,6 +1025,7 @@ class Model_Diffusers:
                 comma_padding_backtrack=comma_padding_backtrack
             )
 
+    @traced("create_prompt_embeds")
     def create_prompt_embeds(
         self,
         prompt,
@@ -926,31 +1035,9 @@ class Model_Diffusers:
         syntax_weights,
     ):
         if self.class_name == "StableDiffusionPipeline":
-            if self.embed_loaded != textual_inversion and textual_inversion != []:
+            if self.embed_loaded != textual_inversion:
                 # Textual Inversion
-                for name, directory_name in textual_inversion:
-                    try:
-                        if directory_name.endswith(".pt"):
-                            model = torch.load(directory_name, map_location=self.device)
-                            model_tensors = model.get("string_to_param").get("*")
-                            s_model = {"emb_params": model_tensors}
-                            # save_file(s_model, directory_name[:-3] + '.safetensors')
-                            self.pipe.load_textual_inversion(s_model, token=name)
-
-                        else:
-                            # self.pipe.text_encoder.resize_token_embeddings(len(self.pipe.tokenizer),pad_to_multiple_of=128)
-                            # self.pipe.load_textual_inversion("./bad_prompt.pt", token="baddd")
-                            self.pipe.load_textual_inversion(directory_name, token=name)
-                        if not self.gui_active:
-                            logger.info(f"Applied : {name}")
-
-                    except Exception as e:
-                        exception = str(e)
-                        if name in exception:
-                            logger.debug(f"Previous loaded embed {name}")
-                        else:
-                            logger.error(exception)
-                            logger.error(f"Can't apply embed {name}")
+                self.textual_inversion_manager.sync(self.pipe, textual_inversion, verbose=not getattr(self, "gui_active", False))
                 self.embed_loaded = textual_inversion
 
             if syntax_weights not in OLD_PROMPT_WEIGHT_OPTIONS:
@@ -975,9 +1062,9 @@ class Model_Diffusers:
                 )
 
             # Prompt weights for textual inversion
-            prompt_ti = self.pipe.maybe_convert_prompt(prompt, self.pipe.tokenizer)
-            negative_prompt_ti = self.pipe.maybe_convert_prompt(
-                negative_prompt, self.pipe.tokenizer
+            prompt_ti = maybe_convert_prompt(self.pipe, prompt, self.pipe.tokenizer)
+            negative_prompt_ti = maybe_convert_prompt(
+                self.pipe, negative_prompt, self.pipe.tokenizer
             )
 
             # separate the multi-vector textual inversion by comma
@@ -1007,23 +1094,9 @@ class Model_Diffusers:
 
         else:
             # SDXL embed
-            if self.embed_loaded != textual_inversion and textual_inversion != []:
+            if self.embed_loaded != textual_inversion:
                 # Textual Inversion
-                for name, directory_name in textual_inversion:
-                    try:
-                        from safetensors.torch import load_file
-                        state_dict = load_file(directory_name)
-                        self.pipe.load_textual_inversion(state_dict["clip_g"], token=name, text_encoder=self.pipe.text_encoder_2, tokenizer=self.pipe.tokenizer_2)
-                        self.pipe.load_textual_inversion(state_dict["clip_l"], token=name, text_encoder=self.pipe.text_encoder, tokenizer=self.pipe.tokenizer)
-                        if not self.gui_active:
-                            logger.info(f"Applied : {name}")
-                    except Exception as e:
-                        exception = str(e)
-                        if name in exception:
-                            logger.debug(f"Previous loaded embed {name}")
-                        else:
-                            logger.error(exception)
-                            logger.error(f"Can't apply embed {name}")
+                self.textual_inversion_manager.sync(self.pipe, textual_inversion, verbose=not getattr(self, "gui_active", False))
                 self.embed_loaded = textual_inversion
 
             if syntax_weights not in OLD_PROMPT_WEIGHT_OPTIONS:
@@ -1059,8 +1132,8 @@ class Model_Diffusers:
 
             # Prompt weights for textual inversion
             try:
-                prompt_ti = self.pipe.maybe_convert_prompt(prompt, self.pipe.tokenizer)
-                negative_prompt_ti = self.pipe.maybe_convert_prompt(negative_prompt, self.pipe.tokenizer)
+                prompt_ti = maybe_convert_prompt(self.pipe, prompt, self.pipe.tokenizer)
+                negative_prompt_ti = maybe_convert_prompt(self.pipe, negative_prompt, self.pipe.tokenizer)
             except Exception as e:
                 logger.debug(str(e))
                 prompt_ti = prompt
@@ -1068,8 +1141,11 @@ class Model_Diffusers:
                 logger.error("FAILED: Convert prompt for textual inversion")
 
             # prompt syntax style a1...
+            # The conversion tokenizes each weighted segment once with the first tokenizer to
+            # chunk it; compel then tokenizes its own fragments once per tokenizer. Those ids
+            # aren't reused, it would take replacing compel and change the Classic embeddings.
             if syntax_weights == "Classic":
-                self.pipe.to("cuda")
+                self.pipe.to(self.device)
                 prompt_ti = get_embed_new(prompt_ti, self.pipe, self.compel, only_convert_string=True)
                 negative_prompt_ti = get_embed_new(negative_prompt_ti, self.pipe, self.compel, only_convert_string=True)
             else:
@@ -1081,15 +1157,13 @@ class Model_Diffusers:
             return conditioning, pooled
 
     def process_lora(self, select_lora, lora_weights_scale, unload=False):
-        device = "cuda" if torch.cuda.is_available() else "cpu"
         if not unload:
             if select_lora is not None:
                 try:
-                    self.pipe = lora_mix_load(
+                    self.lora_manager.load(
                         self.pipe,
                         select_lora,
                         lora_weights_scale,
-                        device=device,
                         dtype=self.type_model_precision,
                     )
                     logger.info(select_lora)
@@ -1100,22 +1174,71 @@ class Model_Diffusers:
                     logger.debug(f"{str(e)}")
             return self.pipe
         else:
-            # Unload numerically unstable but fast and need less memory
+            # Restores the original weights of the layers of the LoRA
             if select_lora is not None:
                 try:
-                    self.pipe = lora_mix_load(
-                        self.pipe,
-                        select_lora,
-                        -lora_weights_scale,
-                        device=device,
-                        dtype=self.type_model_precision,
-                    )
+                    self.lora_manager.unload(self.pipe, select_lora, lora_weights_scale)
                     logger.debug(f"Unload LoRA: {select_lora}")
                 except Exception as e:
                     logger.debug(str(e))
                     pass
             return self.pipe
 
+    def update_loras(self, loras):
+        """
+        Applies the list of LoRAs [(path, scale), ...], only loading, unloading or
+        rescaling the LoRAs that changed since the previous call. The scales of a
+        LoRA that is repeated are added.
+        """
+        requested = {}
+        for lora_path, lora_scale in loras:
+            if lora_path is not None:
+                requested[lora_path] = requested.get(lora_path, 0.0) + lora_scale
+
+        if requested == self.lora_memory:
+            for single_lora in self.lora_memory:
+                logger.info(f"LoRA in memory: {single_lora}")
+            return
+
+        logger.debug("Update LoRAs")
+        self.lora_manager.prefetch(
+            self.pipe,
+            [lora_path for lora_path in requested if lora_path not in self.lora_memory],
+            dtype=self.type_model_precision,
+        )
+        for lora_path, lora_scale in self.lora_memory.items():
+            if lora_path not in requested:
+                self.process_lora(lora_path, lora_scale, unload=True)
+
+        for lora_path, lora_scale in requested.items():
+            previous_scale = self.lora_memory.get(lora_path)
+            if previous_scale is None:
+                self.process_lora(lora_path, lora_scale)
+            elif previous_scale != lora_scale:
+                try:
+                    self.lora_manager.set_scale(self.pipe, lora_path, lora_scale, previous_scale)
+                    logger.info(f"{lora_path} | scale {lora_scale}")
+                except ValueError:
+                    # it failed to load before
+                    self.process_lora(lora_path, lora_scale)
+
+        self.lora_memory = requested
+
+    def prefetch_flash_loras(self):
+        """
+        Keeps the factors of every flash LoRA (LCM, TCD) of the base model cached, so
+        switching between the flash samplers and the others doesn't read the Hub again.
+        A flash LoRA that fails is not tried again until the base model changes.
+        """
+        for flash_lora in dict.fromkeys(FLASH_LORA[self.class_name].values()):
+            if flash_lora in self.flash_lora_failures:
+                continue
+            try:
+                self.lora_manager.pin(self.pipe, flash_lora, dtype=self.type_model_precision)
+            except Exception as e:
+                self.flash_lora_failures.add(flash_lora)
+                logger.debug(f"Flash LoRA not prefetched: {flash_lora} {str(e)}")
+
     def load_style_file(self, style_json_file):
         if os.path.exists(style_json_file):
             try:
@@ -1309,28 +1432,43 @@ class Model_Diffusers:
 
         return image_embeds, processed_masks
 
-    def callback_pipe(self, iter, t, latents):
-        # convert latents to image
-        with torch.no_grad():
-            latents = 1 / 0.18215 * latents
-            image = self.pipe.vae.decode(latents).sample
+    def get_latent_previewer(self, preview_method):
+        model_type = "sdxl" if self.class_name == "StableDiffusionXLPipeline" else "sd1.5"
+        if (
+            self.latent_previewer is None
+            or self.latent_previewer.method != preview_method
+            or self.latent_previewer.model_type != model_type
+        ):
+            self.latent_previewer = LatentPreviewer(preview_method, model_type)
+        return self.latent_previewer
 
-            image = (image / 2 + 0.5).clamp(0, 1)
+    def display_preview(self, step, images):
+        # show one image
+        if self.preview_handle is None:
+            self.preview_handle = display(images[0], display_id=True)
+        else:
+            self.preview_handle.update(images[0])
 
-            # we always cast to float32 as this does not cause significant overhead and is compatible with bfloa16
-            image = image.cpu().permute(0, 2, 3, 1).float().numpy()
+    def callback_pipe(self, iter, t, latents):
+        # full vae decode of the latents
+        images = LatentPreviewer("vae").decode(latents, self.pipe.vae)
+        self.display_preview(iter, images)
 
-            # convert to PIL Images
-            image = self.pipe.numpy_to_pil(image)
+    def __call__(self, *args, **kwargs):
+        """
+        The call function for the generation, see `stream_generation` for the parameters.
 
-            # show one image
-            # global preview_handle
-            if self.preview_handle is None:
-                self.preview_handle = display(image[0], display_id=True)
-            else:
-                self.preview_handle.update(image[0])
+        Returns:
+            The images and saved image paths of the last loop of `loop_generation`.
+        """
+        for result in self.stream_generation(*args, **kwargs):
+            pass
+        return result.images, result.image_paths
 
-    def __call__(
+    @release_on_cancel
+    @traces_generation
+    @ends_open_stages
+    def stream_generation(
         self,
         prompt: str = "",
         negative_prompt: str = "",
@@ -1354,6 +1492,7 @@ class Model_Diffusers:
         lora_scale_D: float = 1.0,
         lora_E: Optional[str] = None,
         lora_scale_E: float = 1.0,
+        loras: List[Tuple[str, float]] = [],
         textual_inversion: List[Tuple[str, str]] = [],
         FreeU: bool = False,
         adetailer_A: bool = False,
@@ -1409,12 +1548,19 @@ class Model_Diffusers:
         retain_detailfix_model_previous_load: bool = False,
         retain_hires_model_previous_load: bool = False,
         image_previews: bool = False,
+        preview_method: str = "linear",
+        preview_interval: int = 5,
+        preview_callback: Optional[Callable] = None,
         xformers_memory_efficient_attention: bool = False,
         gui_active: bool = False,
+        cancellation_token: Optional[CancellationToken] = None,
+        deadline: Optional[float] = None,
+        profiler: Optional[GenerationProfiler] = None,
     ):
 
         """
-        The call function for the generation.
+        Runs the generation and yields a `GenerationResult` (images, seeds, image_paths, timings, stages)
+        as soon as each loop of `loop_generation` is finished. `stages` holds the profiler records of the loop.
 
         Args:
             prompt (str , optional):
@@ -1475,6 +1621,9 @@ class Model_Diffusers:
                 Placeholder for lora E parameter.
             lora_scale_E (float, optional, defaults to 1.0):
                 Placeholder for lora scale E parameter.
+            loras (List[Tuple[str, float]], optional, defaults to []):
+                Any number of additional LoRAs, applied with lora_A to lora_E. [("<path_lora>", <scale>),...]
+                Only the LoRAs added, removed or with a new scale since the previous generation are updated.
             textual_inversion (List[Tuple[str, str]], optional, defaults to []):
                 Placeholder for textual inversion list of tuples. Help the model to adapt to a particular
                 style. [("<token_activation>","<path_embeding>"),...]
@@ -1582,9 +1731,10 @@ class Model_Diffusers:
             retain_compel_previous_load (bool, optional, defaults to False):
                 The previous compel remains preloaded in memory.
             retain_detailfix_model_previous_load (bool, optional, defaults to False):
-                The previous adetailer model remains preloaded in memory.
+                The ControlNet of the SD 1.5 adetailer remains preloaded in memory. The adetailer
+                and hires pipelines share the base model components and are always reused.
             retain_hires_model_previous_load (bool, optional, defaults to False):
-                The previous hires model remains preloaded in memory.
+                Kept for compatibility, the hires pipeline has no weights of its own.
             ip_adapter_image (Optional[Any], optional, default=[]):
                 Image path or list of image paths for ip adapter.
             ip_adapter_mask (Optional[Any], optional, default=[]):
@@ -1609,10 +1759,25 @@ class Model_Diffusers:
                 Adapter mode or list of adapter modes. Possible values are 'original', 'style', 'layout', 'style+layout'.
             image_previews (bool, optional, defaults to False):
                 Displaying the image denoising process.
+            preview_method (str, optional, defaults to "linear"):
+                How previews are decoded from the latents. Options: "linear" (latent to RGB projection, low-res and
+                almost free), "taesd" (tiny decoder), "vae" (full decode, slowest).
+            preview_interval (int, optional, defaults to 5):
+                Number of denoising steps between previews.
+            preview_callback (Callable, optional):
+                Receives `(step, images)` with the PIL previews. If not provided, the previews are displayed with IPython.
             xformers_memory_efficient_attention (bool, optional, defaults to False):
                 Improves generation time, currently disabled.
             gui_active (bool, optional, defaults to False):
                 utility when used with a GUI, it changes the behavior especially by displaying confirmation messages or options.
+            cancellation_token (CancellationToken, optional):
+                Token checked after each denoising step and between stages; calling its `cancel()` from another thread
+                aborts the generation with `GenerationCancelled`.
+            deadline (float, optional):
+                Wall-clock limit as a `time.time()` value. Past it, the generation is aborted with `GenerationTimeout`.
+            profiler (GenerationProfiler, optional):
+                Records time and memory usage per stage and per denoising step, and sends them to its hooks.
+                Without it only the times of the stages are measured.
 
         Specific parameter usage details:
 
@@ -1683,13 +1848,15 @@ class Model_Diffusers:
         self.gui_active = gui_active
         self.image_previews = image_previews
 
-        if self.pipe is None:
-            self.load_pipe(
-                self.base_model_id,
-                task_name=self.task_name,
-                vae_model=self.vae_model,
-                reload=True,
-            )
+        # Cancellation and deadline
+        if deadline is not None:
+            cancellation_token = (cancellation_token or CancellationToken()).with_deadline(deadline)
+
+        def check_cancelled():
+            if cancellation_token is not None:
+                cancellation_token.raise_if_cancelled()
+
+        profiler, step_callbacks = self.prepare_generation(profiler, cancellation_token)
 
         self.pipe.set_progress_bar_config(leave=leave_progress_bar)
         self.pipe.set_progress_bar_config(disable=disable_progress_bar)
@@ -1699,7 +1866,18 @@ class Model_Diffusers:
             self.pipe.disable_xformers_memory_efficient_attention()
         self.pipe.to(self.device)
 
+        if image_previews:
+            self.preview_handle = None
+            step_callbacks.append(
+                self.get_latent_previewer(preview_method).step_callback(
+                    preview_callback or self.display_preview,
+                    preview_interval,
+                    self.pipe.vae,
+                )
+            )
+
         # Load style prompt file
+        profiler.begin("style")
         if style_json_file != "" and style_json_file != self.style_json_file:
             self.load_style_file(style_json_file)
         # Set style
@@ -1707,58 +1885,22 @@ class Model_Diffusers:
             style_prompt = [style_prompt]
         if style_prompt != [""]:
             prompt, negative_prompt = apply_style(style_prompt, prompt, negative_prompt, self.styles_data, self.STYLE_NAMES)
+        profiler.end("style")
 
         # LoRA load
-        if self.lora_memory == [
-            lora_A,
-            lora_B,
-            lora_C,
-            lora_D,
-            lora_E,
-        ] and self.lora_scale_memory == [
-            lora_scale_A,
-            lora_scale_B,
-            lora_scale_C,
-            lora_scale_D,
-            lora_scale_E,
-        ]:
-            for single_lora in self.lora_memory:
-                if single_lora is not None:
-                    logger.info(f"LoRA in memory: {single_lora}")
-            pass
-
-        else:
-            logger.debug("_un, re and load_ lora")
-            self.pipe = self.process_lora(
-                self.lora_memory[0], self.lora_scale_memory[0], unload=True
-            )
-            self.pipe = self.process_lora(
-                self.lora_memory[1], self.lora_scale_memory[1], unload=True
-            )
-            self.pipe = self.process_lora(
-                self.lora_memory[2], self.lora_scale_memory[2], unload=True
-            )
-            self.pipe = self.process_lora(
-                self.lora_memory[3], self.lora_scale_memory[3], unload=True
-            )
-            self.pipe = self.process_lora(
-                self.lora_memory[4], self.lora_scale_memory[4], unload=True
-            )
+        profiler.begin("lora")
+        self.update_loras(
+            [
+                (lora_A, lora_scale_A),
+                (lora_B, lora_scale_B),
+                (lora_C, lora_scale_C),
+                (lora_D, lora_scale_D),
+                (lora_E, lora_scale_E),
+            ] + list(loras)
+        )
 
-            self.pipe = self.process_lora(lora_A, lora_scale_A)
-            self.pipe = self.process_lora(lora_B, lora_scale_B)
-            self.pipe = self.process_lora(lora_C, lora_scale_C)
-            self.pipe = self.process_lora(lora_D, lora_scale_D)
-            self.pipe = self.process_lora(lora_E, lora_scale_E)
-
-        self.lora_memory = [lora_A, lora_B, lora_C, lora_D, lora_E]
-        self.lora_scale_memory = [
-            lora_scale_A,
-            lora_scale_B,
-            lora_scale_C,
-            lora_scale_D,
-            lora_scale_E,
-        ]
+        if sampler in FLASH_AUTO_LOAD_SAMPLER:
+            self.prefetch_flash_loras()
 
         if sampler in FLASH_AUTO_LOAD_SAMPLER and self.flash_config is None:
             # First load
@@ -1782,7 +1924,9 @@ class Model_Diffusers:
                 self.process_lora(flash_task_lora, 1.0)
                 self.flash_config = flash_task_lora
             logger.info(sampler)
+        profiler.end("lora")
 
+        profiler.begin("ip_adapter")
         if not isinstance(ip_adapter_image, list):
             ip_adapter_image = [ip_adapter_image]
         if not isinstance(ip_adapter_mask, list):
@@ -1833,6 +1977,7 @@ class Model_Diffusers:
         if self.ip_adapter_config:
             self.set_ip_adapter_multimode_scale(ip_scales, ip_adapter_mode)
             self.pipe.to(self.device)
+        profiler.end("ip_adapter")
 
         # FreeU
         if FreeU:
@@ -1852,6 +1997,7 @@ class Model_Diffusers:
         if hasattr(self, "compel") and not retain_compel_previous_load:
             del self.compel
 
+        profiler.begin("prompt_encoding")
         prompt_emb, negative_prompt_emb = self.create_prompt_embeds(
             prompt=prompt,
             negative_prompt=negative_prompt,
@@ -1859,6 +2005,7 @@ class Model_Diffusers:
             clip_skip=clip_skip,
             syntax_weights=syntax_weights,
         )
+        profiler.end("prompt_encoding")
 
         if self.class_name != "StableDiffusionPipeline":
             # Additional prompt for SDXL
@@ -1883,6 +2030,7 @@ class Model_Diffusers:
         self.pipe.safety_checker = None
 
         # Reference image
+        profiler.begin("preprocess")
         if self.task_name != "txt2img":
             array_rgb = convert_image_to_numpy_array(image, gui_active)
 
@@ -1908,6 +2056,7 @@ class Model_Diffusers:
                 distance_threshold=distance_threshold,
                 t2i_adapter_preprocessor=t2i_adapter_preprocessor,
             )
+        profiler.end("preprocess")
 
         # Task Parameters
         pipe_params_config = {
@@ -1918,6 +2067,7 @@ class Model_Diffusers:
                 "clip_skip": None,
                 "num_images_per_prompt": num_images,
         }
+        pipe_params_config.update(step_callback_kwargs(self.pipe, step_callbacks))
 
         if self.task_name == "txt2img":
             pipe_params_config["height"] = img_height
@@ -1987,6 +2137,7 @@ class Model_Diffusers:
                 }
 
         # detailfix params and pipe global
+        profiler.begin("task_models")
         if adetailer_A or adetailer_B:
 
             # global params detailfix
@@ -2005,33 +2156,15 @@ class Model_Diffusers:
             }
 
             # Pipe detailfix_pipe
-            if not hasattr(self, "detailfix_pipe") or not retain_detailfix_model_previous_load:
-                if adetailer_A_params.get("inpaint_only", False) == True or adetailer_B_params.get("inpaint_only", False) == True:
-                    detailfix_pipe = custom_task_model_loader(
-                        pipe=self.pipe,
-                        model_category="detailfix",
-                        task_name=self.task_name,
-                        torch_dtype=self.type_model_precision
-                    )
-                else:
-                    detailfix_pipe = custom_task_model_loader(
-                        pipe=self.pipe,
-                        model_category="detailfix_img2img",
-                        task_name=self.task_name,
-                        torch_dtype=self.type_model_precision
-                    )
-                if hasattr(self, "detailfix_pipe"):
-                    del self.detailfix_pipe
-            if retain_detailfix_model_previous_load:
-                if hasattr(self, "detailfix_pipe"):
-                    detailfix_pipe = self.detailfix_pipe
-                else:
-                    self.detailfix_pipe = detailfix_pipe
+            if adetailer_A_params.get("inpaint_only", False) == True or adetailer_B_params.get("inpaint_only", False) == True:
+                detailfix_pipe = self.get_task_model("detailfix")
+            else:
+                detailfix_pipe = self.get_task_model("detailfix_img2img")
             adetailer_A_params.pop("inpaint_only", None)
             adetailer_B_params.pop("inpaint_only", None)
 
             # Define base scheduler detailfix
-            detailfix_pipe.default_scheduler = copy.deepcopy(self.default_scheduler)
+            detailfix_pipe.default_scheduler = self.default_scheduler
             if adetailer_A_params.get("sampler", "Use same sampler") != "Use same sampler":
                 logger.debug("detailfix_pipe will use the sampler from adetailer_A")
                 detailfix_pipe.scheduler = self.get_scheduler(adetailer_A_params["sampler"])
@@ -2070,6 +2203,8 @@ class Model_Diffusers:
                         "ip_adapter_masks": ip_adapter_masks
                     }
 
+            detailfix_params_A.update(step_callback_kwargs(detailfix_pipe, step_callbacks))
+
             # clear params yolo
             adetailer_A_params.pop('strength', None)
             adetailer_A_params.pop('prompt', None)
@@ -2153,6 +2288,8 @@ class Model_Diffusers:
                         "ip_adapter_masks": ip_adapter_masks
                     }
 
+            detailfix_params_B.update(step_callback_kwargs(detailfix_pipe, step_callbacks))
+
             # clear params yolo
             adetailer_B_params.pop('strength', None)
             adetailer_B_params.pop('prompt', None)
@@ -2271,26 +2408,15 @@ class Model_Diffusers:
                 hires_params_config["negative_pooled_prompt_embeds"] = hires_pooled[1:2]
 
             # Hires pipe
-            if not hasattr(self, "hires_pipe") or not retain_hires_model_previous_load:
-                hires_pipe = custom_task_model_loader(
-                    pipe=self.pipe,
-                    model_category="hires",
-                    task_name=self.task_name,
-                    torch_dtype=self.type_model_precision
-                )
-                if hasattr(self, "hires_pipe"):
-                    del self.hires_pipe
-            if retain_hires_model_previous_load:
-                if hasattr(self, "hires_pipe"):
-                    hires_pipe = self.hires_pipe
-                else:
-                    self.hires_pipe = hires_pipe
+            hires_pipe = self.get_task_model("hires")
 
             # Hires scheduler
             if hires_sampler != "Use same sampler":
                 logger.debug("New hires sampler")
                 hires_pipe.scheduler = self.get_scheduler(hires_sampler)
 
+            hires_params_config.update(step_callback_kwargs(hires_pipe, step_callbacks))
+
             hires_pipe.set_progress_bar_config(leave=leave_progress_bar)
             hires_pipe.set_progress_bar_config(disable=disable_progress_bar)
             hires_pipe.to(self.device)
@@ -2300,6 +2426,8 @@ class Model_Diffusers:
             hires_params_config = {}
             hires_pipe = None
 
+        profiler.end("task_models")
+
         # Debug info
         try:
             logger.debug(f"INFO PIPE: {self.pipe.__class__.__name__}")
@@ -2317,6 +2445,9 @@ class Model_Diffusers:
 
         # === RUN PIPE === #
         for i in range(loop_generation):
+            check_cancelled()
+            loop_records = len(profiler.records)
+            profiler.begin("loop")
 
             # number seed
             if seed == -1:
@@ -2346,12 +2477,15 @@ class Model_Diffusers:
             pipe_params_config["generator"] = generators if self.task_name != "img2img" else generators[0]  # no list
             seeds = seeds if self.task_name != "img2img" else [seeds[0]] * num_images
 
+            profiler.begin("denoise")
             try:
                 images = self.pipe(
                     **pipe_params_config,
                 ).images
                 if self.task_name not in ["txt2img", "inpaint", "img2img"]:
                     images = [control_image] + images
+            except GenerationCancelled:
+                raise
             except Exception as e:
                 e = str(e)
                 if "Tensor with 2 elements cannot be converted to Scalar" in e:
@@ -2373,11 +2507,15 @@ class Model_Diffusers:
 
             torch.cuda.empty_cache()
             gc.collect()
+            profiler.end("denoise")
+
+            check_cancelled()
 
             if hires_before_adetailer and upscaler_model_path is not None:
                 logger.debug(
                     "Hires before; same seed for each image (no batch)"
                 )
+                profiler.begin("hires")
                 images = process_images_high_resolution(
                     images,
                     upscaler_model_path,
@@ -2387,7 +2525,9 @@ class Model_Diffusers:
                     self.task_name,
                     generators[0],  # pipe_params_config["generator"][0], # no generator
                     hires_pipe,
+                    profiler=profiler,
                 )
+                profiler.end("hires")
 
             # Adetailer stuff
             if adetailer_A or adetailer_B:
@@ -2395,6 +2535,7 @@ class Model_Diffusers:
                 # for img_single in images:
                 # image_ad = img_single.convert("RGB")
                 # image_pil_list.append(image_ad)
+                profiler.begin("adetailer")
                 if self.task_name not in ["txt2img", "inpaint", "img2img"]:
                     images = images[1:]
 
@@ -2403,13 +2544,16 @@ class Model_Diffusers:
                         pipe_params_df=detailfix_params_A,
                         detailfix_pipe=detailfix_pipe,
                         image_list_task=images,
+                        profiler=profiler,
                         **adetailer_A_params,
                     )
                 if adetailer_B:
+                    check_cancelled()
                     images = ad_model_process(
                         pipe_params_df=detailfix_params_B,
                         detailfix_pipe=detailfix_pipe,
                         image_list_task=images,
+                        profiler=profiler,
                         **adetailer_B_params,
                     )
 
@@ -2418,11 +2562,14 @@ class Model_Diffusers:
                 # del detailfix_pipe
                 torch.cuda.empty_cache()
                 gc.collect()
+                profiler.end("adetailer")
 
             if hires_after_adetailer and upscaler_model_path is not None:
+                check_cancelled()
                 logger.debug(
                     "Hires after; same seed for each image (no batch)"
                 )
+                profiler.begin("hires")
                 images = process_images_high_resolution(
                     images,
                     upscaler_model_path,
@@ -2432,7 +2579,9 @@ class Model_Diffusers:
                     self.task_name,
                     generators[0],  # pipe_params_config["generator"][0], # no generator
                     hires_pipe,
+                    profiler=profiler,
                 )
+                profiler.end("hires")
 
             logger.info(f"Seeds: {seeds}")
 
@@ -2445,6 +2594,7 @@ class Model_Diffusers:
                     time.sleep(0.5)
 
             # List images and save
+            profiler.begin("save")
             image_list = []
             metadata = [
                 prompt,
@@ -2470,13 +2620,235 @@ class Model_Diffusers:
 
             torch.cuda.empty_cache()
             gc.collect()
+            profiler.end("save")
 
             if image_list[0] != "not saved in storage":
                 logger.info(image_list)
 
+            timings, stages = self.end_loop(profiler, loop_records)
+            try:
+                yield GenerationResult(images, seeds, image_list, timings, stages)
+            except GeneratorExit:
+                # the consumer stopped early, skip the remaining loops
+                break
+
         if hasattr(self, "compel") and not retain_compel_previous_load:
             del self.compel
+        if not retain_detailfix_model_previous_load:
+            self.release_task_models()
         torch.cuda.empty_cache()
         gc.collect()
 
-        return images, image_list
+    def prepare_generation(self, profiler, cancellation_token):
+        """
+        Returns the profiler of a generation (a timing-only one if None) and its denoising
+        step callbacks, and loads the pipe again if it was released.
+        """
+        if profiler is None:
+            # only the timings, the memory counters are process-wide
+            profiler = GenerationProfiler(memory=False)
+
+        # Denoising step hooks
+        step_callbacks = [profiler.step_callback]
+        if cancellation_token is not None:
+            step_callbacks.append(cancellation_token.step_callback)
+
+        if self.pipe is None:
+            profiler.begin("load_pipe")
+            self.load_pipe(
+                self.base_model_id,
+                task_name=self.task_name,
+                vae_model=self.vae_model,
+                reload=True,
+            )
+            profiler.end("load_pipe")
+
+        return profiler, step_callbacks
+
+    @staticmethod
+    def end_loop(profiler, loop_records):
+        """
+        Ends the "loop" stage and returns the wall time of each of its direct stages (and
+        "total"), and its records from the index `loop_records`.
+        """
+        loop_record = profiler.end("loop")
+        stages = profiler.records[loop_records:]
+        timings = {
+            record["name"]: record["wall_time"]
+            for record in stages if record["type"] == "stage" and record["depth"] == loop_record["depth"] + 1
+        }
+        timings["total"] = loop_record["wall_time"]
+        return timings, stages
+
+    def pad_batch_conditioning(self, conditionings, loras, textual_inversion, clip_skip, syntax_weights):
+        """
+        Pads the [positive, negative] conditioning of each prompt to the longest one with
+        the conditioning of an empty prompt, as compel does for a single prompt.
+        """
+        max_length = max(conditioning.shape[1] for conditioning in conditionings)
+        padded = []
+        for conditioning, row in zip(conditionings, loras):
+            if conditioning.shape[1] < max_length:
+                with self.lora_manager.row_loras(self.pipe, [row], self.type_model_precision):
+                    empty = self.create_prompt_embeds("", "", textual_inversion, clip_skip, syntax_weights)[0][0:1]
+                missing = max_length - conditioning.shape[1]
+                if missing % empty.shape[1] != 0:
+                    raise ValueError("The prompt embeddings can't be padded to the same length")
+                empty = empty.to(conditioning.dtype).repeat(conditioning.shape[0], missing // empty.shape[1], 1)
+                conditioning = torch.cat([conditioning, empty], dim=1)
+            padded.append(conditioning)
+        return padded
+
+    @release_on_cancel
+    @ends_open_stages
+    def generate_batch(
+        self,
+        prompts: List[str],
+        negative_prompts: Optional[List[str]] = None,
+        loras: Optional[List[List[Tuple[str, float]]]] = None,
+        img_height: int = 512,
+        img_width: int = 512,
+        num_steps: int = 30,
+        guidance_scale: float = 7.5,
+        clip_skip: Optional[bool] = True,
+        seeds: Optional[List[int]] = None,
+        sampler: str = "DPM++ 2M",
+        syntax_weights: str = "Classic",
+        textual_inversion: List[Tuple[str, str]] = [],
+        save_generated_images: bool = True,
+        image_storage_location: str = "./images",
+        generator_in_cpu: bool = False,
+        cancellation_token: Optional[CancellationToken] = None,
+        profiler: Optional[GenerationProfiler] = None,
+    ):
+        """
+        Generates one image for each prompt with a single txt2img pipeline call, so requests
+        with different prompts and LoRAs share every UNet forward. The prompts that need fewer
+        chunks than the longest one are padded with the conditioning of an empty prompt, their
+        images may differ slightly from generating them alone.
+
+        Args:
+            prompts (List[str]):
+                One prompt for each image of the batch.
+            negative_prompts (List[str], optional):
+                One negative prompt for each prompt, empty if not provided.
+            loras (List[List[Tuple[str, float]]], optional):
+                The LoRAs of each prompt, [[("<path_lora>", <scale>), ...], ...]. They are only applied to the
+                batch rows of their prompt, in the text encoders and the UNet, which needs `fuse_loras=False`.
+                The LoRAs of the previous `stream_generation` are unloaded first, so each image matches a
+                generation of its prompt alone with its LoRAs.
+            seeds (List[int], optional):
+                One seed for each prompt, random if not provided.
+            cancellation_token (CancellationToken, optional):
+                Token checked after each denoising step.
+            profiler (GenerationProfiler, optional):
+                Records time and memory usage per stage and per denoising step.
+
+            The other parameters work as in `stream_generation`.
+
+        Returns:
+            A `GenerationResult` with the images in the order of the prompts.
+        """
+        if self.task_name != "txt2img":
+            raise ValueError("generate_batch only supports the txt2img task")
+
+        batch_size = len(prompts)
+        if negative_prompts is None:
+            negative_prompts = [""] * batch_size
+        if loras is None:
+            loras = [[] for _ in prompts]
+        if seeds is None:
+            seeds = [random.randint(0, 2147483647) for _ in prompts]
+        if not len(negative_prompts) == len(loras) == len(seeds) == batch_size:
+            raise ValueError("negative_prompts, loras and seeds need one entry for each prompt")
+        if img_height % 8 != 0 or img_width % 8 != 0:
+            raise ValueError("The width and height must be divisible by 8")
+
+        profiler, step_callbacks = self.prepare_generation(profiler, cancellation_token)
+        self.pipe.to(self.device)
+        loop_records = len(profiler.records)
+        profiler.begin("loop")
+
+        # Only the LoRAs of each row apply
+        profiler.begin("lora")
+        self.update_loras([])
+        profiler.end("lora")
+
+        # Each prompt is encoded with the LoRAs of its row
+        profiler.begin("prompt_encoding")
+        if hasattr(self, "compel"):
+            del self.compel
+        conditionings, pooleds = [], []
+        for prompt, negative_prompt, row in zip(prompts, negative_prompts, loras):
+            with self.lora_manager.row_loras(self.pipe, [row], self.type_model_precision):
+                prompt_emb, negative_prompt_emb = self.create_prompt_embeds(
+                    prompt, negative_prompt, textual_inversion, clip_skip, syntax_weights
+                )
+            if self.class_name == "StableDiffusionPipeline":
+                conditionings.append(torch.cat([prompt_emb, negative_prompt_emb]))
+            else:
+                # sdxl: conditioning and pooled of [prompt, negative prompt]
+                conditionings.append(prompt_emb)
+                pooleds.append(negative_prompt_emb)
+        conditionings = self.pad_batch_conditioning(conditionings, loras, textual_inversion, clip_skip, syntax_weights)
+        if hasattr(self, "compel"):
+            del self.compel
+        profiler.end("prompt_encoding")
+
+        self.pipe.scheduler = self.get_scheduler(sampler)
+        self.pipe.safety_checker = None
+
+        generators = []
+        for seed in seeds:
+            if generator_in_cpu or self.device.type == "cpu":
+                generators.append(torch.Generator().manual_seed(seed))
+            else:
+                generators.append(torch.Generator("cuda").manual_seed(seed))
+
+        pipe_params_config = {
+            "num_inference_steps": num_steps,
+            "guidance_scale": guidance_scale,
+            "height": img_height,
+            "width": img_width,
+            "num_images_per_prompt": 1,
+            "generator": generators,
+            "prompt_embeds": torch.cat([c[0:1] for c in conditionings]),
+            "negative_prompt_embeds": torch.cat([c[1:2] for c in conditionings]),
+        }
+        if pooleds:
+            pipe_params_config["pooled_prompt_embeds"] = torch.cat([p[0:1] for p in pooleds])
+            pipe_params_config["negative_pooled_prompt_embeds"] = torch.cat([p[1:2] for p in pooleds])
+        pipe_params_config.update(step_callback_kwargs(self.pipe, step_callbacks))
+
+        profiler.begin("denoise")
+        with self.lora_manager.row_loras(self.pipe, loras, self.type_model_precision):
+            images = self.pipe(**pipe_params_config).images
+        profiler.end("denoise")
+
+        profiler.begin("save")
+        image_list = []
+        for image_, prompt, negative_prompt, seed in zip(images, prompts, negative_prompts, seeds):
+            image_path = "not saved in storage"
+            if save_generated_images:
+                metadata = [
+                    prompt,
+                    negative_prompt,
+                    self.base_model_id,
+                    self.vae_model,
+                    num_steps,
+                    guidance_scale,
+                    sampler,
+                    seed,
+                    img_width,
+                    img_height,
+                    clip_skip,
+                ]
+                image_path = save_pil_image_with_metadata(image_, image_storage_location, metadata)
+            image_list.append(image_path)
+        profiler.end("save")
+
+        timings, stages = self.end_loop(profiler, loop_records)
+
+        torch.cuda.empty_cache()
+        gc.collect()
+        return GenerationResult(images, seeds, image_list, timings, stages)
@@ -1,6 +1,9 @@
 from __future__ import annotations
 import math
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+import threading
+import itertools
+import weakref
 import torch
 import gc
 import re
@@ -88,10 +91,10 @@ class Emphasis:
     """tokens from the chunk of the prompt"""
 
     multipliers: torch.Tensor
-    """tensor with multipliers, once for each token"""
+    """tensor with multipliers, once for each token, (chunks, tokens)"""
 
     z: torch.Tensor
-    """output of cond transformers network (CLIP)"""
+    """output of cond transformers network (CLIP), (chunks, tokens, channels) with the tokens of every prompt of each chunk index"""
 
     def after_transformers(self):
         """Called after cond transformers network has processed the chunk of the prompt; this function should modify self.z to apply the emphasis"""
@@ -114,11 +117,12 @@ class EmphasisOriginal(Emphasis):
     description = "the original emphasis implementation"
 
     def after_transformers(self):
-        original_mean = self.z.mean()
+        original_mean = self.z.mean(dim=(-2, -1), keepdim=True)
         self.z = self.z * self.multipliers.reshape(self.multipliers.shape + (1,)).expand(self.z.shape)
 
         # restoring original mean is likely not correct, but it seems to work well to prevent artifacts that happen otherwise
-        new_mean = self.z.mean()
+        # (for each chunk index)
+        new_mean = self.z.mean(dim=(-2, -1), keepdim=True)
         self.z = self.z * (original_mean / new_mean)
 
 
@@ -166,6 +170,53 @@ chunk. Those objects are found in PromptChunk.fixes and, are placed into FrozenC
 are applied by sd_hijack.EmbeddingsWithFixes's forward function."""
 
 
+class PromptChunkCache:
+    """
+    Bounded LRU of the chunks of each prompt line, shared by every prompt processor of
+    the process, so that repeated negative prompts and style suffixes are parsed and
+    tokenized once. The key has a serial number of the tokenizer, never reused like an
+    `id()`, and its added tokens with their ids, which change when textual inversions
+    are loaded or removed.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._tokenizer_serials = weakref.WeakKeyDictionary()
+        self._next_serial = itertools.count()
+
+    def vocabulary_key(self, tokenizer):
+        with self._lock:
+            serial = self._tokenizer_serials.get(tokenizer)
+            if serial is None:
+                serial = self._tokenizer_serials[tokenizer] = next(self._next_serial)
+        return (serial, tuple(sorted(tokenizer.added_tokens_encoder.items())))
+
+    def get(self, tokenizer, key):
+        key = self.vocabulary_key(tokenizer) + key
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, tokenizer, key, value):
+        key = self.vocabulary_key(tokenizer) + key
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+prompt_chunk_cache = PromptChunkCache()
+
+
 class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
     """A pytorch module that is a wrapper for FrozenCLIPEmbedder module. it enhances FrozenCLIPEmbedder, making it possible to
     have unlimited prompt length and assign weights to tokens in prompt.
@@ -303,16 +354,20 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
 
         token_count = 0
 
-        cache = {}
         batch_chunks = []
         for line in texts:
-            if line in cache:
-                chunks = cache[line]
-            else:
-                chunks, current_token_count = self.tokenize_line(line)
-                token_count = max(current_token_count, token_count)
-
-                cache[line] = chunks
+            # the text is tokenized by the tokenizer of the pipe, the special tokens come from self.tokenizer
+            key = (
+                self.emphasis, self.comma_padding_backtrack, self.chunk_length,
+                self.comma_token, self.id_start, self.id_end, line,
+            )
+            cached = prompt_chunk_cache.get(self.wrapped.tokenizer, key)
+            if cached is None:
+                cached = self.tokenize_line(line)
+                prompt_chunk_cache.put(self.wrapped.tokenizer, key, cached)
+
+            chunks, current_token_count = cached
+            token_count = max(current_token_count, token_count)
 
             batch_chunks.append(chunks)
 
@@ -330,22 +385,28 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
 
         chunk_count = max([len(x) for x in batch_chunks])
 
-        zs = []
-        for i in range(chunk_count):
-            batch_chunk = [chunks[i] if i < len(chunks) else self.empty_chunk() for chunks in batch_chunks]
+        # all the chunks of all the texts in one batch for the text encoder, ordered by chunk index
+        batch_chunk = [
+            chunks[i] if i < len(chunks) else self.empty_chunk()
+            for i in range(chunk_count)
+            for chunks in batch_chunks
+        ]
 
-            tokens = [x.tokens for x in batch_chunk]
-            multipliers = [x.multipliers for x in batch_chunk]
+        tokens = [x.tokens for x in batch_chunk]
+        multipliers = [x.multipliers for x in batch_chunk]
 
-            z = self.process_tokens(tokens, multipliers)
-            zs.append(z)
+        z, pooled = self.process_tokens(tokens, multipliers, chunk_count)
 
         if self.get_pooled:  # hasattr(zs, "pooled"): # if zs.shape[-1] == 1280:
-            return torch.hstack(zs), zs[0].pooled  # self.pooled
+            return z, pooled
         else:
-            return torch.hstack(zs)
+            return z
 
-    def process_tokens(self, remade_batch_tokens, batch_multipliers):
+    def process_tokens(self, remade_batch_tokens, batch_multipliers, chunk_count=1):
+        """
+        Encodes `chunk_count` chunks of each text in one call and returns the chunks of
+        each text concatenated (B, chunk_count * 77, C), and the pooled output of the first chunk
+        """
         tokens = torch.asarray(remade_batch_tokens).to(self.device)
 
         # this is for SD2: SD1 uses the same token for padding and end of text, while SD2 uses different ones.
@@ -359,19 +420,23 @@ class FrozenCLIPEmbedderWithCustomWordsBase(torch.nn.Module):
         else:
             z, pooled = self.encode_with_transformers(tokens)
 
+        batch_size = tokens.shape[0] // chunk_count
+        token_length = tokens.shape[1]
+
         emphasis = get_current_option(self.emphasis)()
         emphasis.tokens = remade_batch_tokens
-        emphasis.multipliers = torch.asarray(batch_multipliers).to(self.device)
-        emphasis.z = z
+        emphasis.multipliers = torch.asarray(batch_multipliers).to(self.device).reshape(chunk_count, -1)
+        emphasis.z = z.reshape(chunk_count, batch_size * token_length, z.shape[-1])
 
         emphasis.after_transformers()
 
-        z = emphasis.z
+        z = emphasis.z.reshape(chunk_count, batch_size, token_length, -1)
+        z = z.transpose(0, 1).reshape(batch_size, chunk_count * token_length, -1)
 
         if pooled is not None:
-            z.pooled = pooled
+            pooled = pooled[:batch_size]
 
-        return z
+        return z, pooled
 
 
 class StableDiffusionLongPromptProcessor(FrozenCLIPEmbedderWithCustomWordsBase):
@@ -122,7 +122,7 @@ def detokenize(chunk, actual_prompt):
     actual_prompt = actual_prompt.replace(chanked_prompt,'')
     return chanked_prompt.strip(), actual_prompt.strip()
 
-def tokenize_line(line, tokenizer): # split into chunks
+def tokenize_line_legacy(line, tokenizer): # split into chunks
     actual_prompt = line.lower().strip()
     actual_tokens = tokenizer.tokenize(actual_prompt)
     max_tokens = tokenizer.model_max_length - 2
@@ -154,6 +154,98 @@ def tokenize_line(line, tokenizer): # split into chunks
 
     return chunks
 
+def token_spans(text, tokens):
+    """Character span of each token in `text`, None if the tokens can't be mapped back onto the text"""
+    spans = []
+    position = 0
+    for token in tokens:
+        piece = token[:-4] if token.endswith('</w>') else token
+        if text.startswith(' ', position):
+            position += 1
+        if not piece or not text.startswith(piece, position):
+            return None
+        spans.append((position, position + len(piece)))
+        position += len(piece)
+    if position != len(text):
+        return None
+    return spans
+
+def chunk_bounds(tokens, max_tokens, comma_token):
+    """Splits the tokens in chunks of max_tokens, cutting after the last comma of a full chunk"""
+    bounds = []
+    start = 0
+    while len(tokens) - start >= max_tokens:
+        end = start + max_tokens
+        if tokens[end - 1] != comma_token:
+            for i in range(end - 2, start - 1, -1):
+                if tokens[i] == comma_token:
+                    end = i + 1
+                    break
+        bounds.append((start, end))
+        start = end
+    if start < len(tokens):
+        bounds.append((start, len(tokens)))
+    return bounds
+
+def split_line(line, tokenizer, comma_token=None):
+    """
+    Chunks of the line as (text, tokens) with a single tokenizer pass, using the
+    character offsets of the tokens. Returns None when the tokens don't map back
+    onto the text (e.g. non ascii characters) and the legacy chunker is needed.
+    """
+    actual_prompt = line.lower().strip()
+    actual_tokens = tokenizer.tokenize(actual_prompt)
+    spans = token_spans(actual_prompt, actual_tokens)
+    if spans is None:
+        return None
+
+    comma_token = comma_token or tokenizer.tokenize(',')[0]
+    return [
+        (actual_prompt[spans[start][0]:spans[end - 1][1]], actual_tokens[start:end])
+        for start, end in chunk_bounds(actual_tokens, tokenizer.model_max_length - 2, comma_token)
+    ]
+
+def split_comma_pieces(text, tokenizer, comma_token):
+    """
+    Same as `[split_line(piece) for piece in text.split(',')]` but tokenizing
+    the text once. None if a comma is merged with other punctuation, where
+    the tokens of the pieces would differ from the tokens of the text.
+    """
+    actual_prompt = text.lower().strip()
+    actual_tokens = tokenizer.tokenize(actual_prompt)
+    spans = token_spans(actual_prompt, actual_tokens)
+    if spans is None:
+        return None
+
+    max_tokens = tokenizer.model_max_length - 2
+    pieces = []
+    start = 0
+    for i, token in enumerate(actual_tokens + [comma_token]):
+        if ',' not in token:
+            continue
+        if token != comma_token or (i > 0 and not actual_tokens[i - 1].endswith('</w>')):
+            return None
+        piece_tokens = actual_tokens[start:i]
+        pieces.append([
+            (actual_prompt[spans[start + s][0]:spans[start + e - 1][1]], piece_tokens[s:e])
+            for s, e in chunk_bounds(piece_tokens, max_tokens, comma_token)
+        ])
+        start = i + 1
+    return pieces
+
+def tokenize_line(line, tokenizer): # split into chunks
+    chunks = split_line(line, tokenizer)
+    if chunks is None:
+        return tokenize_line_legacy(line, tokenizer)
+    return [text for text, _ in chunks]
+
+def chunk_length(text, tokens, previous_token, tokenizer):
+    # tokens of f'{text},', counted without tokenizing again when the chunk is whole words
+    # that don't end with punctuation, where the comma is always one more token
+    if tokens[-1].endswith('</w>') and (previous_token is None or previous_token.endswith('</w>')) and text[-1].isalnum():
+        return len(tokens) + 1
+    return len(tokenizer.tokenize(f'{text},'))
+
 def get_embed_new(prompt, pipeline, compel, only_convert_string=False, compel_process_sd=False):
 
     if compel_process_sd:
@@ -165,14 +257,27 @@ def get_embed_new(prompt, pipeline, compel, only_convert_string=False, compel_pr
     # Convert to Compel
     attention = parse_prompt_attention(prompt)
     global_attention_chanks = []
+    comma_token = pipeline.tokenizer.tokenize(',')[0]
 
     for att in attention:
-        for chank in att[0].split(','):
-            temp_prompt_chanks = tokenize_line(chank, pipeline.tokenizer)
-            for small_chank in temp_prompt_chanks:
+        pieces = split_comma_pieces(att[0], pipeline.tokenizer, comma_token)
+        if pieces is None:
+            pieces = [split_line(chank, pipeline.tokenizer, comma_token) for chank in att[0].split(',')]
+        for chank, temp_prompt_chanks in zip(att[0].split(','), pieces):
+            if temp_prompt_chanks is None:
+                temp_prompt_chanks = [
+                    (small_chank, None) for small_chank in tokenize_line_legacy(chank, pipeline.tokenizer)
+                ]
+            previous_token = None
+            for small_chank, tokens in temp_prompt_chanks:
+                if tokens is None:
+                    lenght = len(pipeline.tokenizer.tokenize(f'{small_chank},'))
+                else:
+                    lenght = chunk_length(small_chank, tokens, previous_token, pipeline.tokenizer)
+                    previous_token = tokens[-1]
                 temp_dict = {
                     "weight": round(att[1], 2),
-                    "lenght": len(pipeline.tokenizer.tokenize(f'{small_chank},')),
+                    "lenght": lenght,
                     "prompt": f'{small_chank},'
                 }
                 global_attention_chanks.append(temp_dict)
@@ -203,6 +308,14 @@ def get_embed_new(prompt, pipeline, compel, only_convert_string=False, compel_pr
 
     return merge_embeds([prompt_attention_to_invoke_prompt(i) for i in global_prompt_chanks], compel)
 
+def maybe_convert_prompt(pipe, prompt, tokenizer):
+    # pipe.maybe_convert_prompt tokenizes the whole prompt to look for the textual inversion
+    # tokens, skipped when none of them is in the text
+    prompt_lower = prompt.lower()
+    if not any(token.lower() in prompt_lower for token in tokenizer.added_tokens_encoder):
+        return prompt
+    return pipe.maybe_convert_prompt(prompt, tokenizer)
+
 def add_comma_after_pattern_ti(text):
     pattern = re.compile(r'\b\w+_\d+\b')
     modified_text = pattern.sub(lambda x: x.group() + ',', text)
@@ -0,0 +1,268 @@
+# =====================================
+# Textual inversion
+# =====================================
+import os
+import threading
+from collections import OrderedDict
+import torch
+from safetensors.torch import load_file
+from .multi_emphasis_prompt import prompt_chunk_cache
+from ..logging.logging_setup import logger
+
+EMBEDDING_CACHE_SIZE = 64
+
+_embedding_cache = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
+
+def file_cache_key(path):
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def load_embedding_file(path):
+    """
+    Returns the embeddings of a textual inversion file as CPU tensors:
+    {"clip_l": ..., "clip_g": ...} for SDXL and {"emb_params": ...} for SD1.5.
+    The last `EMBEDDING_CACHE_SIZE` parsed files are cached by path, size and modification time.
+    """
+    key = file_cache_key(path)
+    with _embedding_cache_lock:
+        embeddings = _embedding_cache.get(key)
+        if embeddings is not None:
+            _embedding_cache.move_to_end(key)
+    if embeddings is not None:
+        return embeddings
+
+    if path.endswith(".safetensors"):
+        state_dict = load_file(path)
+    else:
+        state_dict = torch.load(path, map_location="cpu")
+
+    if "string_to_param" in state_dict:
+        # A1111
+        embeddings = {"emb_params": state_dict["string_to_param"]["*"]}
+    elif "clip_l" in state_dict or "clip_g" in state_dict:
+        embeddings = {k: v for k, v in state_dict.items() if k in ("clip_l", "clip_g")}
+    elif len(state_dict) == 1:
+        # diffusers
+        embeddings = {"emb_params": next(iter(state_dict.values()))}
+    else:
+        raise ValueError(f"Unknown textual inversion format: {path}")
+
+    with _embedding_cache_lock:
+        _embedding_cache[key] = embeddings
+        while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _embedding_cache.popitem(last=False)
+    return embeddings
+
+
+def vector_tokens(name, embedding):
+    # the tokens diffusers adds for a multi-vector embedding
+    num_vectors = embedding.shape[0] if embedding.dim() > 1 else 1
+    return [name] + [f"{name}_{i}" for i in range(1, num_vectors)]
+
+
+def supports_token_removal(tokenizer):
+    # remove_tokens edits private fields of the slow tokenizers of transformers >= 4.34
+    return all(
+        hasattr(tokenizer, name) for name in ("_added_tokens_decoder", "_added_tokens_encoder", "_update_trie")
+    )
+
+
+def remove_tokenizer_tokens(tokenizer, tokens):
+    """Removes added tokens from the tokenizer, shifting the ids of the tokens added after them."""
+    removed_ids = sorted(tokenizer.added_tokens_encoder[t] for t in set(tokens) if t in tokenizer.added_tokens_encoder)
+    if not removed_ids:
+        return removed_ids
+
+    decoder = dict(tokenizer._added_tokens_decoder)
+    tokenizer._added_tokens_decoder.clear()
+    tokenizer._added_tokens_encoder.clear()
+    shift = 0
+    for token_id in sorted(decoder):
+        if shift < len(removed_ids) and token_id == removed_ids[shift]:
+            shift += 1
+            continue
+        added_token = decoder[token_id]
+        tokenizer._added_tokens_decoder[token_id - shift] = added_token
+        tokenizer._added_tokens_encoder[added_token.content] = token_id - shift
+    tokenizer._update_trie()
+    return removed_ids
+
+
+def remove_tokens(tokenizer, text_encoder, tokens):
+    """
+    Removes added tokens from the tokenizer and their rows from the token embeddings.
+    `pipe.unload_textual_inversion` is not used, it reassigns the wrong ids when the
+    removed tokens aren't the last ones.
+    """
+    removed_ids = remove_tokenizer_tokens(tokenizer, tokens)
+    if not removed_ids:
+        return
+
+    input_embeddings = text_encoder.get_input_embeddings()
+    keep = torch.ones(input_embeddings.weight.shape[0], dtype=torch.bool)
+    keep[removed_ids] = False
+    weight = input_embeddings.weight.data[keep.to(input_embeddings.weight.device)]
+    new_embeddings = torch.nn.Embedding(
+        weight.shape[0], weight.shape[1], device=weight.device, dtype=weight.dtype
+    )
+    new_embeddings.weight.data = weight
+    text_encoder.set_input_embeddings(new_embeddings)
+    text_encoder.config.vocab_size = weight.shape[0]
+
+
+def restore_vocabulary(pipe, tokenizer, text_encoder, added_tokens, num_embeddings):
+    """
+    Undoes a failed load: removes the tokens missing from `added_tokens` and trims
+    the token embeddings back to `num_embeddings` rows.
+    """
+    new_tokens = [token for token in tokenizer.added_tokens_encoder if token not in added_tokens]
+    if new_tokens:
+        if supports_token_removal(tokenizer):
+            remove_tokenizer_tokens(tokenizer, new_tokens)
+        else:
+            text_encoder.resize_token_embeddings(len(tokenizer))
+            pipe.unload_textual_inversion(tokens=new_tokens, tokenizer=tokenizer, text_encoder=text_encoder)
+    if text_encoder.get_input_embeddings().weight.shape[0] != num_embeddings:
+        text_encoder.resize_token_embeddings(num_embeddings)
+
+
+class TextualInversionManager:
+    """
+    Keeps the textual inversions of the tokenizers and text encoders of a pipeline
+    in sync with a requested list of (token, path), loading and unloading only the
+    difference. All the new embeddings of a text encoder are added with a single
+    resize of its token embedding matrix.
+    """
+
+    def __init__(self):
+        self.loaded = {}  # name: (path, tokens)
+
+    @staticmethod
+    def text_encoders(pipe):
+        if hasattr(pipe, "text_encoder_2"):
+            return [
+                ("clip_l", pipe.tokenizer, pipe.text_encoder),
+                ("clip_g", pipe.tokenizer_2, pipe.text_encoder_2),
+            ]
+        return [("emb_params", pipe.tokenizer, pipe.text_encoder)]
+
+    def sync(self, pipe, textual_inversion, verbose=True):
+        requested = {name: path for name, path in textual_inversion}
+
+        remove = [name for name, (path, _) in self.loaded.items() if requested.get(name) != path]
+        if remove:
+            self.unload(pipe, remove)
+
+        add = [(name, path) for name, path in requested.items() if name not in self.loaded]
+        if add:
+            self.load(pipe, add, verbose)
+
+        if remove or add:
+            # the ids of the tokens changed, the cached chunks of the prompts are stale
+            prompt_chunk_cache.clear()
+
+        return [name for name in requested if name in self.loaded]
+
+    def unload(self, pipe, names):
+        encoders = self.text_encoders(pipe)
+        if not all(supports_token_removal(tokenizer) for _, tokenizer, _ in encoders):
+            # unload every embedding and load the others again
+            kept = [(name, path) for name, (path, _) in self.loaded.items() if name not in names]
+            tokens = [token for _, tokens in self.loaded.values() for token in tokens]
+            for _, tokenizer, text_encoder in encoders:
+                pipe.unload_textual_inversion(tokens=tokens, tokenizer=tokenizer, text_encoder=text_encoder)
+            self.loaded = {}
+            logger.debug(f"Unload embeds {names} with a full reload")
+            self.load(pipe, kept, verbose=False)
+            return
+
+        tokens = []
+        for name in names:
+            tokens += self.loaded.pop(name)[1]
+            logger.debug(f"Unload embed {name}")
+
+        for _, tokenizer, text_encoder in encoders:
+            remove_tokens(tokenizer, text_encoder, tokens)
+
+    def load(self, pipe, textual_inversion, verbose=True):
+        encoders = self.text_encoders(pipe)
+
+        valid = []
+        for name, path in textual_inversion:
+            if name in pipe.tokenizer.added_tokens_encoder:
+                logger.debug(f"Previous loaded embed {name}")
+                continue
+
+            if not os.path.isfile(path) and len(encoders) == 1:
+                # directory or Hub repo, loaded by diffusers
+                try:
+                    pipe.load_textual_inversion(path, token=name)
+                    self.loaded[name] = (path, [t for t in pipe.tokenizer.added_tokens_encoder if t == name or t.startswith(f"{name}_")])
+                    if verbose:
+                        logger.info(f"Applied : {name}")
+                except Exception as e:
+                    logger.error(str(e))
+                    logger.error(f"Can't apply embed {name}")
+                continue
+
+            try:
+                embeddings = load_embedding_file(path)
+                for key, _, text_encoder in encoders:
+                    if key not in embeddings:
+                        raise ValueError(f"The embedding has no '{key}' weights")
+                    expected_dim = text_encoder.get_input_embeddings().weight.shape[-1]
+                    if embeddings[key].shape[-1] != expected_dim:
+                        raise ValueError(
+                            f"The embedding size {embeddings[key].shape[-1]} doesn't match the text encoder size {expected_dim}"
+                        )
+            except Exception as e:
+                logger.error(str(e))
+                logger.error(f"Can't apply embed {name}")
+                continue
+            valid.append((name, path, embeddings))
+
+        if not valid:
+            return
+
+        if not self.add_embeddings(pipe, encoders, valid):
+            # one at a time, skipping the ones that fail
+            logger.debug("Loading the embeds one by one")
+            valid = [entry for entry in valid if self.add_embeddings(pipe, encoders, [entry])]
+
+        for name, path, embeddings in valid:
+            self.loaded[name] = (path, vector_tokens(name, embeddings[encoders[0][0]]))
+            if verbose:
+                logger.info(f"Applied : {name}")
+
+    @staticmethod
+    def add_embeddings(pipe, encoders, entries):
+        """
+        Adds the (name, path, embeddings) `entries` to every text encoder with a single
+        resize each. If it fails none is added and False is returned.
+        """
+        states = [
+            (dict(tokenizer.added_tokens_encoder), text_encoder.get_input_embeddings().weight.shape[0])
+            for _, tokenizer, text_encoder in encoders
+        ]
+        names = [name for name, _, _ in entries]
+        try:
+            for key, tokenizer, text_encoder in encoders:
+                pipe.load_textual_inversion(
+                    [embeddings[key] for _, _, embeddings in entries],
+                    token=names,
+                    tokenizer=tokenizer,
+                    text_encoder=text_encoder,
+                )
+        except Exception as e:
+            for (_, tokenizer, text_encoder), (added_tokens, num_embeddings) in zip(encoders, states):
+                restore_vocabulary(pipe, tokenizer, text_encoder, added_tokens, num_embeddings)
+            if len(entries) == 1:
+                logger.error(str(e))
+                logger.error(f"Can't apply embed {names[0]}")
+            else:
+                logger.debug(str(e))
+            return False
+        return True
@@ -0,0 +1,148 @@
+# =====================================
+# Timesteps cache
+# =====================================
+import ast
+import copy
+import json
+import inspect
+import textwrap
+import threading
+import functools
+from collections import OrderedDict
+import numpy as np
+import torch
+from ..logging.logging_setup import logger
+
+TIMESTEPS_CACHE_SIZE = 256
+
+_timesteps_cache = OrderedDict()
+_timesteps_cache_lock = threading.Lock()
+_written_attributes = {}
+
+
+def timesteps_key(scheduler, args, kwargs):
+    """(scheduler class, config, set_timesteps arguments), None if an argument can't be a key."""
+    arguments = []
+    for value in list(args) + [kwargs[name] for name in sorted(kwargs)]:
+        if isinstance(value, torch.device):
+            value = str(value)
+        elif isinstance(value, list):
+            value = tuple(value)
+        elif value is not None and not isinstance(value, (int, float, str, tuple)):
+            return None
+        arguments.append(value)
+
+    config = json.dumps(dict(scheduler.config), sort_keys=True, default=str)
+    return (type(scheduler), config, tuple(arguments), tuple(sorted(kwargs)))
+
+
+def written_attributes(scheduler_class):
+    """
+    Names of the attributes assigned by `set_timesteps` of `scheduler_class`, read from
+    its source. None if it can't be read or the method also changes the config.
+    """
+    if scheduler_class not in _written_attributes:
+        names = None
+        try:
+            tree = ast.parse(textwrap.dedent(inspect.getsource(scheduler_class.set_timesteps)))
+        except (OSError, TypeError, SyntaxError):
+            tree = None
+
+        if tree is not None:
+            names = set()
+            for node in ast.walk(tree):
+                if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign)):
+                    targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+                    for target in targets:
+                        for item in ast.walk(target):
+                            if (
+                                isinstance(item, ast.Attribute)
+                                and isinstance(item.value, ast.Name)
+                                and item.value.id == "self"
+                            ):
+                                names.add(item.attr)
+                elif (
+                    isinstance(node, ast.Call)
+                    and isinstance(node.func, ast.Attribute)
+                    and node.func.attr == "register_to_config"
+                ):
+                    names = None
+                    break
+
+        if names is None:
+            logger.debug(f"Timesteps of {scheduler_class.__name__} are not cached")
+        _written_attributes[scheduler_class] = None if names is None else frozenset(names)
+
+    return _written_attributes[scheduler_class]
+
+
+def _clone(value):
+    # `step` fills the lists of a run (model outputs, derivatives) and may edit tensors in place
+    if isinstance(value, torch.Tensor):
+        return value.clone()
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    if type(value) in (list, tuple):
+        return type(value)(_clone(item) for item in value)
+    if type(value) is dict:
+        return {name: _clone(item) for name, item in value.items()}
+    return value
+
+
+class CachedSetTimesteps:
+    """
+    `set_timesteps` of one scheduler memoized process-wide: the attributes it assigns
+    (timesteps, sigmas, step counters) are stored per scheduler class, config and
+    arguments, and restored without recomputing the Karras, EDM or Lu schedules.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        # keeps the signature, the pipelines inspect it to know the accepted arguments
+        functools.update_wrapper(self, type(scheduler).set_timesteps.__get__(scheduler))
+
+    def __call__(self, *args, **kwargs):
+        scheduler = self.scheduler
+        names = written_attributes(type(scheduler))
+        key = None if names is None else timesteps_key(scheduler, args, kwargs)
+        if key is None:
+            return self.__wrapped__(*args, **kwargs)
+
+        with _timesteps_cache_lock:
+            state = _timesteps_cache.get(key)
+            if state is not None:
+                _timesteps_cache.move_to_end(key)
+
+        if state is None:
+            result = self.__wrapped__(*args, **kwargs)
+            attributes = vars(scheduler)
+            state = {name: _clone(attributes[name]) for name in names if name in attributes}
+            with _timesteps_cache_lock:
+                _timesteps_cache[key] = state
+                while len(_timesteps_cache) > TIMESTEPS_CACHE_SIZE:
+                    _timesteps_cache.popitem(last=False)
+            return result
+
+        vars(scheduler).update({name: _clone(value) for name, value in state.items()})
+
+    def __reduce__(self):
+        return (CachedSetTimesteps, (self.scheduler,))
+
+
+def cache_timesteps(scheduler):
+    """
+    Makes `scheduler` use the process-wide timesteps cache. Only `set_timesteps` of the
+    instance is wrapped, the class is unchanged. A shallow copy would still cache into
+    the original, copy it with `copy_scheduler`.
+    """
+    if not isinstance(vars(scheduler).get("set_timesteps"), CachedSetTimesteps):
+        scheduler.set_timesteps = CachedSetTimesteps(scheduler)
+    return scheduler
+
+
+def copy_scheduler(scheduler):
+    """Shallow copy of `scheduler`, using the timesteps cache if the original does."""
+    scheduler_copy = copy.copy(scheduler)
+    if isinstance(vars(scheduler).get("set_timesteps"), CachedSetTimesteps):
+        scheduler_copy.set_timesteps = CachedSetTimesteps(scheduler_copy)
+    return scheduler_copy
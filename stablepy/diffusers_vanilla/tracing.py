@@ -0,0 +1,211 @@
+# =====================================
+# Chrome trace export
+# =====================================
+import os
+import json
+import time
+import inspect
+import threading
+import functools
+from contextlib import contextmanager, nullcontext, ExitStack
+from .instrumentation import GenerationProfiler
+from ..logging.logging_setup import logger
+
+_recorder = None
+_NULL_SPAN = nullcontext()
+
+
+class ChromeTraceRecorder:
+    """
+    Collects trace events in the Chrome trace event format, which can be
+    opened with chrome://tracing or https://ui.perfetto.dev.
+
+    It can also be added as a hook of a `GenerationProfiler` to include
+    its stages and denoising steps in the trace.
+
+    Example:
+        recorder = start_trace()
+        images, image_paths = model(prompt="a cat")
+        stop_trace().save("generation_trace.json")
+    """
+
+    def __init__(self):
+        self.events = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._threads = set()
+
+    def _add(self, event):
+        tid = threading.get_ident()
+        event.update(pid=self._pid, tid=tid)
+        with self._lock:
+            if tid not in self._threads:
+                self._threads.add(tid)
+                self.events.append({
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self._pid,
+                    "tid": tid,
+                    "args": {"name": threading.current_thread().name},
+                })
+            self.events.append(event)
+
+    def complete(self, name, start, end, cat="stablepy", args=None):
+        """Adds a span, `start` and `end` are `time.perf_counter()` values."""
+        self._add({
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (end - start) * 1e6,
+            "args": args or {},
+        })
+
+    def instant(self, name, cat="stablepy", args=None):
+        self._add({
+            "name": name,
+            "cat": cat,
+            "ph": "i",
+            "s": "t",
+            "ts": time.perf_counter() * 1e6,
+            "args": args or {},
+        })
+
+    @contextmanager
+    def span(self, name, cat="stablepy", **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.perf_counter(), cat, args)
+
+    def __call__(self, record):
+        # GenerationProfiler hook, records are emitted when the stage or step ends
+        end = time.perf_counter()
+        if record["type"] == "stage":
+            args = {k: v for k, v in record.items() if k not in ("type", "name", "wall_time")}
+            self.complete(record["name"], end - record["wall_time"], end, "stage", args)
+        else:
+            self.complete(f"step {record['step']}", end - record["wall_time"], end, "step", {"stage": record["stage"]})
+
+    def save(self, path):
+        with self._lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+        with open(path, "w") as trace_file:
+            json.dump(trace, trace_file)
+        logger.info(f"Trace saved: {path}")
+        return path
+
+
+def start_trace(recorder=None):
+    """Starts recording trace events of every generation in the process."""
+    global _recorder
+    _recorder = recorder or ChromeTraceRecorder()
+    return _recorder
+
+
+def stop_trace():
+    """Stops recording and returns the recorder."""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def get_trace_recorder():
+    return _recorder
+
+
+def trace_span(name, cat="stablepy", **args):
+    """Context manager recording a span if a trace is active, otherwise a no-op."""
+    if _recorder is None:
+        return _NULL_SPAN
+    return _recorder.span(name, cat, **args)
+
+
+def traced(name=None, cat="stablepy"):
+    """Decorator recording each call of the function as a span while a trace is active."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return func(*args, **kwargs)
+            with _recorder.span(span_name, cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def traced_method(obj, method_name, name, cat="stablepy"):
+    """
+    Records the calls of `obj.method_name` (e.g. a VAE decode or a scheduler
+    step) as spans while a trace is active, and restores the method on exit.
+    """
+    method = getattr(obj, method_name, None)
+    if method is None or getattr(method, "_traced", False):
+        yield
+        return
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if _recorder is None:
+            return method(*args, **kwargs)
+        with _recorder.span(name, cat):
+            return method(*args, **kwargs)
+
+    wrapper._traced = True
+    own_attribute = method_name in vars(obj)
+    setattr(obj, method_name, wrapper)
+    try:
+        yield
+    finally:
+        if own_attribute:
+            setattr(obj, method_name, method)
+        else:
+            delattr(obj, method_name)
+
+
+@contextmanager
+def profiler_hook(profiler, hook):
+    """Adds `hook` to the hooks of `profiler` and removes it on exit."""
+    if hook in profiler.hooks:
+        yield
+        return
+    profiler.hooks.append(hook)
+    try:
+        yield
+    finally:
+        profiler.hooks.remove(hook)
+
+
+def traces_generation(generator_function):
+    """
+    Decorates `Model_Diffusers.stream_generation`: while a trace is active, the
+    recorder is added to the hooks of its profiler (a new one if it's None) and the
+    decodes of the VAE shared by the main, hires and detailfix pipes are recorded.
+    Both are undone when the generation ends, fails or is closed.
+    """
+    signature = inspect.signature(generator_function)
+
+    @functools.wraps(generator_function)
+    def wrapper(self, *args, **kwargs):
+        recorder = _recorder
+        if recorder is None:
+            return (yield from generator_function(self, *args, **kwargs))
+
+        arguments = signature.bind(self, *args, **kwargs)
+        profiler = arguments.arguments.get("profiler")
+        if profiler is None:
+            profiler = arguments.arguments["profiler"] = GenerationProfiler()
+
+        with ExitStack() as stack:
+            stack.enter_context(profiler_hook(profiler, recorder))
+            if getattr(self, "pipe", None) is not None:
+                stack.enter_context(traced_method(self.pipe.vae, "decode", "vae_decode"))
+            return (yield from generator_function(*arguments.args, **arguments.kwargs))
+
+    return wrapper
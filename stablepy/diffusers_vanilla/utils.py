@@ -1,9 +1,12 @@
 import os
+import inspect
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 from ..logging.logging_setup import logger
+from .tracing import traced
 import torch
 
+@traced("save_image")
 def save_pil_image_with_metadata(image, folder_path, metadata_list):
     if not os.path.exists(folder_path):
         os.makedirs(folder_path)
@@ -65,3 +68,25 @@ def checkpoint_model_type(checkpoint_path):
     del checkpoint
 
     return model_type
+
+
+def step_callback_kwargs(pipe, callbacks):
+    """
+    Pipe call parameters that run every `callback(step, timestep, latents)` in
+    `callbacks` after each denoising step. The list is read on every step, so
+    callbacks can be added after the parameters were created.
+    """
+    if "callback_on_step_end" in inspect.signature(pipe.__call__).parameters:
+        def callback_on_step_end(pipe, step, timestep, callback_kwargs):
+            for callback in callbacks:
+                callback(step, timestep, callback_kwargs["latents"])
+            return callback_kwargs
+
+        return {"callback_on_step_end": callback_on_step_end}
+
+    # pipes without the new api
+    def callback_legacy(step, timestep, latents):
+        for callback in callbacks:
+            callback(step, timestep, latents)
+
+    return {"callback": callback_legacy, "callback_steps": 1}
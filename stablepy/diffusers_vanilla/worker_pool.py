@@ -0,0 +1,170 @@
+# =====================================
+# Preloaded worker pool
+# =====================================
+import os
+import time
+import queue
+import itertools
+import threading
+import traceback
+import multiprocessing
+import torch
+from ..logging.logging_setup import logger
+
+RESULT_POLL_INTERVAL = 0.5
+
+
+class WorkerError(RuntimeError):
+    """
+    A generation failed in a worker or the worker died. `exc_type` is the name of
+    the exception raised in the worker and `worker_traceback` its formatted traceback.
+    """
+
+    def __init__(self, message, exc_type=None, worker_traceback=None):
+        super().__init__(message)
+        self.exc_type = exc_type
+        self.worker_traceback = worker_traceback
+
+
+def _worker_loop(model, tasks, results, current_job, num_threads, cores):
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job_id, params = task
+        # shared memory, unlike the queue it's written before the worker can die
+        current_job.value = job_id
+        try:
+            images, image_list = model(**params)
+            results.put((job_id, "done", (images, image_list)))
+        except Exception as e:
+            # exceptions are not always picklable
+            results.put((job_id, "error", (type(e).__name__, str(e), traceback.format_exc())))
+        current_job.value = -1
+
+
+class ModelWorkerPool:
+    """
+    Forks `num_workers` processes from a parent that has already loaded a CPU
+    `Model_Diffusers`. The workers share the parent's weights copy-on-write
+    (or through the page cache with `memory_map_weights=True`), and each one
+    runs generations with its own share of the CPU cores.
+
+    The parent should not run any generation before the pool is created,
+    the intra-op thread pools of torch are not safe to inherit across fork.
+
+    Example:
+        model = Model_Diffusers(base_model_id, memory_map_weights=True)
+        with ModelWorkerPool(model, num_workers=4) as pool:
+            job = pool.submit(prompt="a cat", num_steps=20)
+            images, image_paths = pool.result(job)
+    """
+
+    def __init__(self, model, num_workers=2, threads_per_worker=None, pin_cores=True):
+        if model.device.type != "cpu":
+            raise ValueError("ModelWorkerPool only supports models on CPU; CUDA can't be shared across fork")
+
+        ctx = multiprocessing.get_context("fork")
+
+        if hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+        if threads_per_worker is None:
+            threads_per_worker = max(1, len(cores) // num_workers)
+
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        self._job_ids = itertools.count()
+        self._finished = {}
+        self._lock = threading.Lock()
+        self._current_jobs = []
+        self.workers = []
+
+        for i in range(num_workers):
+            worker_cores = None
+            if pin_cores and len(cores) >= num_workers * threads_per_worker:
+                worker_cores = cores[i * threads_per_worker:(i + 1) * threads_per_worker]
+            current_job = ctx.Value("q", -1, lock=False)
+            worker = ctx.Process(
+                target=_worker_loop,
+                args=(model, self._tasks, self._results, current_job, threads_per_worker, worker_cores),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+            self._current_jobs.append(current_job)
+
+        logger.info(f"Worker pool: {num_workers} workers with {threads_per_worker} threads each")
+
+    def submit(self, **params):
+        """Queues a generation with the same parameters as `Model_Diffusers.__call__` and returns its job id."""
+        job_id = next(self._job_ids)
+        self._tasks.put((job_id, params))
+        return job_id
+
+    def _dead_worker(self, job_id):
+        # the worker that was running the job, or the last one when they are all dead
+        for worker, current_job in zip(self.workers, self._current_jobs):
+            if current_job.value == job_id and not worker.is_alive():
+                return worker
+        if self.workers and not any(worker.is_alive() for worker in self.workers):
+            return self.workers[-1]
+        return None
+
+    def result(self, job_id, timeout=None):
+        """
+        Waits for a submitted job and returns its `(images, image_paths)`. Raises
+        `queue.Empty` after `timeout` seconds and `WorkerError` if the generation
+        failed or the worker running it died.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if job_id in self._finished:
+                    status, output = self._finished.pop(job_id)
+                    break
+
+            wait = RESULT_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    raise queue.Empty(f"Job {job_id} not finished after {timeout} seconds")
+
+            try:
+                finished_id, status, output = self._results.get(timeout=wait)
+            except queue.Empty:
+                worker = self._dead_worker(job_id)
+                if worker is not None:
+                    raise WorkerError(f"Worker {worker.pid} died with exit code {worker.exitcode} before finishing job {job_id}")
+                continue
+
+            with self._lock:
+                self._finished[finished_id] = (status, output)
+
+        if status == "error":
+            exc_type, message, worker_traceback = output
+            raise WorkerError(
+                f"Generation failed in worker: {exc_type}: {message}\n{worker_traceback}",
+                exc_type=exc_type,
+                worker_traceback=worker_traceback,
+            )
+        return output
+
+    def close(self):
+        for _ in self.workers:
+            self._tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self._current_jobs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -136,6 +136,7 @@ import sys
 import numpy as np
 import torch
 from PIL import Image
+from ..diffusers_vanilla.tracing import trace_span
 
 
 def mod2normal(state_dict):
@@ -351,7 +352,8 @@ def esrgan_upscale(model, img, ESRGAN_tile, ESRGAN_tile_overlap):
         for tiledata in row:
             x, w, tile = tiledata
 
-            output = upscale_without_tiling(model, tile)
+            with trace_span("esrgan_tile", x=x, y=y):
+                output = upscale_without_tiling(model, tile)
             scale_factor = output.width // tile.width
 
             newrow.append([x * scale_factor, w * scale_factor, output])
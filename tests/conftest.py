@@ -0,0 +1,27 @@
+import os
+
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+import pytest
+import torch
+
+from stablepy import Model_Diffusers
+from benchmarks.tiny_models import save_tiny_model, save_tiny_lora
+
+
+@pytest.fixture(scope="session")
+def sd15_folder(tmp_path_factory):
+    return save_tiny_model("sd1.5", str(tmp_path_factory.mktemp("tiny") / "sd15"))
+
+
+@pytest.fixture(scope="session")
+def sd15_model(sd15_folder):
+    return Model_Diffusers(base_model_id=sd15_folder, task_name="txt2img", type_model_precision=torch.float32)
+
+
+
+@pytest.fixture(scope="session")
+def lora_paths(sd15_folder, tmp_path_factory):
+    """Three random kohya LoRAs of the tiny SD 1.5 model."""
+    folder = tmp_path_factory.mktemp("loras")
+    return [save_tiny_lora(sd15_folder, str(folder / f"lora{i}.safetensors"), seed=i) for i in range(3)]
@@ -0,0 +1,28 @@
+import torch
+
+
+def generation_params(**params):
+    base = dict(
+        prompt="a cat, night sky",
+        negative_prompt="blurry",
+        num_steps=3,
+        guidance_scale=7.0,
+        sampler="Euler",
+        img_width=64,
+        img_height=64,
+        seed=1,
+        save_generated_images=False,
+        display_images=False,
+        disable_progress_bar=True,
+    )
+    base.update(params)
+    return base
+
+
+def weights(pipe):
+    """Copy of the UNet and text encoder weights of `pipe`."""
+    return {
+        f"{name}.{key}": value.clone()
+        for name in ("unet", "text_encoder")
+        for key, value in getattr(pipe, name).state_dict().items()
+    }
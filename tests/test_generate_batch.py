@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+import torch
+
+from stablepy import Model_Diffusers
+from tests.helpers import generation_params
+
+PROMPTS = ["a cat, night sky", "a dog in the city", "portrait, blue eyes"]
+SEEDS = [3, 4, 5]
+
+
+@pytest.fixture(scope="module")
+def unfused_model(sd15_folder):
+    return Model_Diffusers(
+        base_model_id=sd15_folder, task_name="txt2img", type_model_precision=torch.float32, fuse_loras=False
+    )
+
+
+def test_rows_match_standalone_generations(unfused_model, lora_paths):
+    rows = [[(lora_paths[0], 0.8)], [], [(lora_paths[1], 0.6), (lora_paths[0], -0.3)]]
+
+    # LoRAs left by a previous generation don't apply to the batch
+    unfused_model(**generation_params(loras=[(lora_paths[2], 1.0)]))
+    assert unfused_model.lora_memory
+
+    result = unfused_model.generate_batch(
+        PROMPTS, loras=rows, seeds=SEEDS, num_steps=3, sampler="Euler", img_width=64, img_height=64,
+        save_generated_images=False,
+    )
+    for image, prompt, row, seed in zip(result.images, PROMPTS, rows, SEEDS):
+        standalone = unfused_model(**generation_params(prompt=prompt, negative_prompt="", loras=row, seed=seed))[0][0]
+        difference = np.abs(np.asarray(image, dtype=np.float32) - np.asarray(standalone, dtype=np.float32))
+        # Batched and single convolutions round a few pixels differently
+        assert difference.max() <= 8 and difference.mean() <= 1, prompt
+
+
+def test_released_pipe_is_loaded_again_on_the_device(unfused_model, monkeypatch):
+    unfused_model.pipe = None
+    moved, moved_before_encoding = [], []
+    load_pipe = unfused_model.load_pipe
+    create_prompt_embeds = unfused_model.create_prompt_embeds
+
+    def spied_load_pipe(*args, **kwargs):
+        load_pipe(*args, **kwargs)
+        to = unfused_model.pipe.to
+        monkeypatch.setattr(unfused_model.pipe, "to", lambda *a, **k: moved.append(a) or to(*a, **k))
+
+    def spied_create_prompt_embeds(*args, **kwargs):
+        moved_before_encoding.append(list(moved))
+        return create_prompt_embeds(*args, **kwargs)
+
+    monkeypatch.setattr(unfused_model, "load_pipe", spied_load_pipe)
+    monkeypatch.setattr(unfused_model, "create_prompt_embeds", spied_create_prompt_embeds)
+    result = unfused_model.generate_batch(
+        PROMPTS[:2], seeds=SEEDS[:2], num_steps=2, sampler="Euler", img_width=64, img_height=64,
+        save_generated_images=False,
+    )
+    assert len(result.images) == 2
+    assert (unfused_model.device,) in moved_before_encoding[0]
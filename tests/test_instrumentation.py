@@ -0,0 +1,94 @@
+import pytest
+import torch
+
+from stablepy import GenerationProfiler, CancellationToken, GenerationCancelled
+from stablepy.diffusers_vanilla import cancellation, instrumentation
+from stablepy.diffusers_vanilla.instrumentation import ends_open_stages
+from tests.helpers import generation_params
+
+
+def test_ends_open_stages_of_a_generator():
+    @ends_open_stages
+    def stages(profiler=None):
+        profiler.begin("outer")
+        profiler.begin("inner")
+        yield 1
+        raise RuntimeError("failed")
+
+    profiler = GenerationProfiler()
+    profiler.begin("caller")
+    with pytest.raises(RuntimeError):
+        list(stages(profiler=profiler))
+    assert [stage["name"] for stage in profiler._open] == ["caller"]
+    assert [(r["name"], r["aborted"]) for r in profiler.records] == [("inner", True), ("outer", True)]
+
+    # closed early by the consumer
+    generator = stages(profiler=profiler)
+    next(generator)
+    generator.close()
+    assert len(profiler._open) == 1
+
+
+def test_stage_context_marks_aborted():
+    profiler = GenerationProfiler()
+    with pytest.raises(ValueError):
+        with profiler.stage("failing"):
+            raise ValueError
+    with profiler.stage("ok"):
+        pass
+    assert [(r["name"], r["aborted"]) for r in profiler.records] == [("failing", True), ("ok", False)]
+
+
+def test_cancelled_generation_closes_the_stages(sd15_model):
+    token = CancellationToken()
+    profiler = GenerationProfiler(hooks=[lambda record: record["type"] == "step" and token.cancel()])
+
+    with pytest.raises(GenerationCancelled):
+        sd15_model(profiler=profiler, cancellation_token=token, **generation_params())
+    assert profiler._open == []
+    assert any(r["type"] == "stage" and r["name"] == "denoise" and r["aborted"] for r in profiler.records)
+
+    # the same profiler measures the next generation
+    profiler.hooks = []
+    sd15_model(profiler=profiler, **generation_params())
+    assert profiler._open == []
+    assert profiler.summary()["denoise"]["calls"] == 2
+
+
+def test_timing_only_profiler_leaves_the_memory_counters(monkeypatch):
+    def untouched(*args, **kwargs):
+        raise AssertionError("memory counter read")
+
+    monkeypatch.setattr(torch.cuda, "is_available", lambda: True)
+    for name in ("reset_peak_memory_stats", "max_memory_allocated", "memory_allocated"):
+        monkeypatch.setattr(torch.cuda, name, untouched)
+    monkeypatch.setattr(instrumentation, "current_rss", untouched)
+    monkeypatch.setattr(instrumentation, "peak_rss", untouched)
+
+    profiler = GenerationProfiler(memory=False)
+    with profiler.stage("outer"):
+        profiler.step_callback(0, 999, None)
+    record = profiler.records[-1]
+    assert record["wall_time"] >= 0
+    assert record["rss"] is None and record["peak_rss"] is None and record["vram_peak"] is None
+
+
+def test_default_profiler_measures_only_times(sd15_model):
+    result = next(sd15_model.stream_generation(**generation_params()))
+    stages = [record for record in result.stages if record["type"] == "stage"]
+    assert stages and all(stage["rss"] is None for stage in stages)
+
+    profiler = GenerationProfiler()
+    sd15_model(profiler=profiler, **generation_params())
+    assert any(record.get("rss") is not None for record in profiler.records)
+
+
+def test_cancelled_call_releases_once(sd15_model, monkeypatch):
+    releases = []
+    monkeypatch.setattr(cancellation.traceback, "clear_frames", releases.append)
+    token = CancellationToken()
+    token.cancel()
+
+    with pytest.raises(GenerationCancelled):
+        sd15_model(cancellation_token=token, **generation_params())
+    assert len(releases) == 1
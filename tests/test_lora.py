@@ -0,0 +1,102 @@
+import os
+
+import pytest
+import torch
+from diffusers import StableDiffusionPipeline
+
+from stablepy.diffusers_vanilla.lora_loader import LoraManager
+from tests.helpers import weights
+
+
+@pytest.fixture
+def pipe(sd15_folder):
+    return StableDiffusionPipeline.from_pretrained(sd15_folder, torch_dtype=torch.float32)
+
+
+def outputs(pipe):
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(0, pipe.tokenizer.vocab_size, (1, 8), generator=generator)
+    latents = torch.randn(1, 4, 8, 8, generator=generator)
+    with torch.no_grad():
+        hidden_states = pipe.text_encoder(input_ids)[0]
+        noise = pipe.unet(latents, 10, encoder_hidden_states=hidden_states).sample
+    return hidden_states, noise
+
+
+@pytest.mark.parametrize("unload_order", [[0, 1, 2], [1, 0, 2], [2, 1, 0]])
+def test_unload_restores_the_weights_exactly(pipe, lora_paths, unload_order):
+    original = weights(pipe)
+    manager = LoraManager()
+    for path, scale in zip(lora_paths, [0.8, -0.5, 1.3]):
+        manager.load(pipe, path, scale, dtype=torch.float32)
+    assert not all(torch.equal(original[k], v) for k, v in weights(pipe).items())
+
+    for i in unload_order:
+        manager.unload(pipe, lora_paths[i])
+
+    for key, value in weights(pipe).items():
+        assert torch.equal(original[key], value), key
+    assert manager.originals == {}
+
+
+def test_fused_matches_diffusers(sd15_folder, lora_paths):
+    fused = StableDiffusionPipeline.from_pretrained(sd15_folder, torch_dtype=torch.float32)
+    LoraManager().load(fused, lora_paths[0], 0.8, dtype=torch.float32)
+
+    reference = StableDiffusionPipeline.from_pretrained(sd15_folder, torch_dtype=torch.float32)
+    reference.load_lora_weights(os.path.dirname(lora_paths[0]), weight_name=os.path.basename(lora_paths[0]))
+    reference.fuse_lora(lora_scale=0.8)
+
+    base = outputs(StableDiffusionPipeline.from_pretrained(sd15_folder, torch_dtype=torch.float32))
+    for output, expected, base_output in zip(outputs(fused), outputs(reference), base):
+        assert not torch.allclose(output, base_output, rtol=1e-3, atol=1e-4)
+        torch.testing.assert_close(output, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_unfused_matches_fused(sd15_folder, lora_paths):
+    fused = StableDiffusionPipeline.from_pretrained(sd15_folder, torch_dtype=torch.float32)
+    unfused = StableDiffusionPipeline.from_pretrained(sd15_folder, torch_dtype=torch.float32)
+    fused_manager, unfused_manager = LoraManager(), LoraManager(fuse=False)
+    for path, scale in zip(lora_paths[:2], [0.8, 0.4]):
+        fused_manager.load(fused, path, scale, dtype=torch.float32)
+        unfused_manager.load(unfused, path, scale, dtype=torch.float32)
+
+    for output, expected in zip(outputs(unfused), outputs(fused)):
+        torch.testing.assert_close(output, expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("cache_size", [0, 1])
+def test_evict_keeps_the_pinned_loras(pipe, lora_paths, cache_size):
+    manager = LoraManager(cache_size=cache_size)
+    manager.pin(pipe, lora_paths[0], dtype=torch.float32)
+    pinned_key = manager.cache_key(lora_paths[0])
+    for path in lora_paths[1:]:
+        manager.get_factors(pipe, path, dtype=torch.float32)
+        manager.get_factors(pipe, path, dtype=torch.float32)
+
+    assert pinned_key in manager.factors_cache
+    assert len([key for key in manager.factors_cache if key != pinned_key]) == cache_size
+
+
+def test_failed_pin_is_not_kept(pipe, tmp_path):
+    manager = LoraManager()
+    missing = str(tmp_path / "missing.safetensors")
+    with pytest.raises(Exception):
+        manager.pin(pipe, missing, dtype=torch.float32)
+    assert not manager.pinned
+
+
+def test_failed_flash_lora_is_not_tried_again(sd15_model, monkeypatch):
+    pinned = []
+
+    def failing_pin(pipe, lora_path, dtype=None):
+        pinned.append(lora_path)
+        raise OSError("offline")
+
+    monkeypatch.setattr(sd15_model, "flash_lora_failures", set())
+    monkeypatch.setattr(sd15_model.lora_manager, "pin", failing_pin)
+    sd15_model.prefetch_flash_loras()
+    tried = list(pinned)
+    sd15_model.prefetch_flash_loras()
+
+    assert tried and pinned == tried
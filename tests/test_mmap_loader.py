@@ -0,0 +1,31 @@
+import os
+
+import torch
+
+from stablepy.diffusers_vanilla.mmap_loader import weights_cache_key
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def test_folder_key_follows_the_component_weights(tmp_path):
+    folder = str(tmp_path / "model")
+    write(os.path.join(folder, "model_index.json"), b"{}")
+    weights = os.path.join(folder, "unet", "diffusion_pytorch_model.safetensors")
+    write(weights, b"old weights")
+    key = weights_cache_key(folder, torch.float16)
+
+    assert weights_cache_key(folder, torch.float16) == key
+    assert weights_cache_key(folder, torch.float32) != key
+
+    # updated in place, model_index.json untouched
+    write(weights, b"new weights!")
+    assert weights_cache_key(folder, torch.float16) != key
+
+    key = weights_cache_key(folder, torch.float16)
+    stat = os.stat(weights)
+    os.utime(weights, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert weights_cache_key(folder, torch.float16) != key
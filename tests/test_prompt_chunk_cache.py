@@ -0,0 +1,49 @@
+import gc
+
+import pytest
+
+from stablepy.diffusers_vanilla.multi_emphasis_prompt import PromptChunkCache
+from benchmarks.tiny_models import build_tokenizer
+
+
+@pytest.fixture
+def tokenizer(tmp_path):
+    return build_tokenizer(str(tmp_path))
+
+
+def test_added_tokens_change_the_key(tokenizer):
+    cache = PromptChunkCache()
+    cache.put(tokenizer, ("zq cat",), "chunks")
+    assert cache.get(tokenizer, ("zq cat",)) == "chunks"
+
+    tokenizer.add_tokens(["zq"])
+    assert cache.get(tokenizer, ("zq cat",)) is None
+
+
+def test_same_length_with_other_tokens_misses(tokenizer):
+    cache = PromptChunkCache()
+    tokenizer.add_tokens(["zq"])
+    cache.put(tokenizer, ("zq cat",), "chunks")
+
+    # remove zq and add wv with the same id, the length doesn't change
+    zq_id = tokenizer.added_tokens_encoder["zq"]
+    added_token = tokenizer._added_tokens_decoder.pop(zq_id)
+    tokenizer._added_tokens_encoder.pop(added_token.content)
+    tokenizer._update_trie()
+    tokenizer.add_tokens(["wv"])
+    assert tokenizer.added_tokens_encoder["wv"] == zq_id
+
+    assert cache.get(tokenizer, ("zq cat",)) is None
+
+
+def test_new_tokenizer_never_hits_the_entries_of_a_collected_one(tmp_path):
+    cache = PromptChunkCache()
+    serials = set()
+    for i in range(5):
+        tokenizer = build_tokenizer(str(tmp_path / str(i)))
+        assert cache.get(tokenizer, ("cat",)) is None
+        cache.put(tokenizer, ("cat",), i)
+        serials.add(cache.vocabulary_key(tokenizer)[0])
+        del tokenizer
+        gc.collect()
+    assert len(serials) == 5
@@ -0,0 +1,131 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from stablepy.diffusers_vanilla.prompt_weights import (
+    parse_prompt_attention,
+    prompt_attention_to_invoke_prompt,
+    tokenize_line,
+    tokenize_line_legacy,
+    get_embed_new,
+)
+from benchmarks.tiny_models import build_tokenizer
+
+WORDS = [
+    "cat", "dog", "city", "sky", "hair", "eyes", "light", "portrait", "photo", "hands",
+    "masterpiece", "best", "quality", "highly", "detailed", "blue", "red", "night",
+    "café", "naïve", "日本", "ñandú", "über", "x2", "8k", "a",
+]
+PUNCTUATION = ["", "", "", "!", ".", "...", ":", ";", "'", "-", "?!"]
+SEPARATORS = [", ", ",", " , ", ",, ", ". ", " ", ",!", "!,", ".,", ", ."]
+
+
+def random_tag(rng):
+    tag = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))) + rng.choice(PUNCTUATION)
+    match rng.randint(0, 5):
+        case 0:
+            return f"({tag}:{rng.choice(['0.5', '0.8', '1.1', '1.3', '1.5'])})"
+        case 1:
+            return f"(({tag}))"
+        case 2:
+            return f"[{tag}]"
+        case _:
+            return tag
+
+
+def random_prompt(seed):
+    rng = random.Random(seed)
+    # up to ~5 chunks of 75 tokens
+    n_tags = rng.choice([1, 3, 10, 30, 60, 120])
+    prompt = ""
+    for _ in range(n_tags):
+        prompt += random_tag(rng) + rng.choice(SEPARATORS)
+    return prompt
+
+
+PROMPTS = [
+    "masterpiece, best quality, a photo of a cat with blue eyes",
+    "café naïve, 日本 cat,über dog",
+    "cat,,dog!,blue.,red ,, night",
+    "(highly detailed cat:1.2), [blurry], ((best quality)), city!,sky",
+    ", ".join(f"{WORDS[i % 10]} {WORDS[(i * 7) % 18]}" for i in range(80)),
+    " ".join(f"{WORDS[i % 18]} {WORDS[i // 18]}" for i in range(120)),
+    ",".join(["日本 cat"] * 60),
+] + [random_prompt(seed) for seed in range(600)]
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    return build_tokenizer(str(tmp_path_factory.mktemp("tokenizer")))
+
+
+def legacy_convert(prompt, tokenizer):
+    # get_embed_new(only_convert_string=True) before the single pass chunker
+    prompt = prompt.replace("((", "(").replace("))", ")")
+    global_attention_chanks = []
+    for att in parse_prompt_attention(prompt):
+        for chank in att[0].split(','):
+            for small_chank in tokenize_line_legacy(chank, tokenizer):
+                global_attention_chanks.append({
+                    "weight": round(att[1], 2),
+                    "lenght": len(tokenizer.tokenize(f'{small_chank},')),
+                    "prompt": f'{small_chank},'
+                })
+
+    max_tokens = tokenizer.model_max_length - 2
+    global_prompt_chanks = []
+    current_list = []
+    current_length = 0
+    for item in global_attention_chanks:
+        if current_length + item['lenght'] > max_tokens:
+            global_prompt_chanks.append(current_list)
+            current_list = [[item['prompt'], item['weight']]]
+            current_length = item['lenght']
+        else:
+            if not current_list:
+                current_list.append([item['prompt'], item['weight']])
+            elif item['weight'] != current_list[-1][1]:
+                current_list.append([item['prompt'], item['weight']])
+            else:
+                current_list[-1][0] += f" {item['prompt']}"
+            current_length += item['lenght']
+    if current_list:
+        global_prompt_chanks.append(current_list)
+
+    return ' '.join([prompt_attention_to_invoke_prompt(i) for i in global_prompt_chanks])
+
+
+def outcome(function, *args, **kwargs):
+    # the legacy chunker fails on some byte-level tokens, the new one must fail the same way
+    try:
+        return function(*args, **kwargs)
+    except Exception as e:
+        return type(e)
+
+
+@pytest.mark.parametrize("prompt", PROMPTS)
+def test_tokenize_line_matches_legacy(prompt, tokenizer):
+    assert outcome(tokenize_line, prompt, tokenizer) == outcome(tokenize_line_legacy, prompt, tokenizer)
+
+
+@pytest.mark.parametrize("prompt", PROMPTS)
+def test_classic_conversion_matches_legacy(prompt, tokenizer):
+    pipeline = SimpleNamespace(tokenizer=tokenizer)
+    converted = outcome(get_embed_new, prompt, pipeline, None, only_convert_string=True)
+    assert converted == outcome(legacy_convert, prompt, tokenizer)
+
+
+def test_repeated_chunks_are_kept(tokenizer):
+    # the legacy chunker drops the chunks that repeat an earlier one
+    prompt = " ".join(["portrait"] * 200)
+    chunks = tokenize_line(prompt, tokenizer)
+    assert [len(tokenizer.tokenize(chunk)) for chunk in chunks] == [75, 75, 50]
+    assert " ".join(chunks) == prompt
+
+
+def test_prompts_cover_long_and_non_ascii_text(tokenizer):
+    assert max(len(tokenizer.tokenize(prompt)) for prompt in PROMPTS) > 4 * 75
+    assert sum(not prompt.isascii() for prompt in PROMPTS) > 100
+    # most prompts are chunked, not compared as two identical errors
+    assert sum(isinstance(outcome(tokenize_line_legacy, prompt, tokenizer), list) for prompt in PROMPTS) > 300
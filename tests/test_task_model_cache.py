@@ -0,0 +1,91 @@
+import contextlib
+
+import diffusers
+import pytest
+import torch
+
+import stablepy.diffusers_vanilla.model as model_module
+from stablepy import Model_Diffusers
+from benchmarks.run_benchmarks import offline_patches
+from benchmarks.tiny_models import save_tiny_model
+from tests.helpers import generation_params
+
+def task_params(**params):
+    """Hires and SD 1.5 inpaint adetailer, a new dict each time as the generation edits it."""
+    return generation_params(
+        upscaler_model_path="Nearest",
+        upscaler_increases_size=1.0,
+        hires_steps=2,
+        adetailer_A=True,
+        adetailer_A_params={
+            "face_detector_ad": True,
+            "person_detector_ad": False,
+            "hand_detector_ad": False,
+            "strength": 0.5,
+            "inpaint_only": True,
+        },
+        **params,
+    )
+
+
+@pytest.fixture
+def model(sd15_folder):
+    return Model_Diffusers(base_model_id=sd15_folder, task_name="txt2img", type_model_precision=torch.float32)
+
+
+@pytest.fixture
+def builds(sd15_folder, monkeypatch):
+    """Counts the task pipelines and the ControlNets built, offline."""
+    counts = {"pipelines": 0, "controlnets": 0}
+    loader = model_module.custom_task_model_loader
+
+    def counting_loader(*args, **kwargs):
+        counts["pipelines"] += 1
+        return loader(*args, **kwargs)
+
+    monkeypatch.setattr(model_module, "custom_task_model_loader", counting_loader)
+    with contextlib.ExitStack() as stack:
+        for patch in offline_patches(sd15_folder):
+            stack.enter_context(patch)
+        controlnet_loader = diffusers.ControlNetModel.from_pretrained
+
+        def counting_controlnet(*args, **kwargs):
+            counts["controlnets"] += 1
+            return controlnet_loader(*args, **kwargs)
+
+        monkeypatch.setattr(diffusers.ControlNetModel, "from_pretrained", counting_controlnet)
+        yield counts
+
+
+def test_task_models_are_built_once(model, builds):
+    for _ in range(3):
+        list(model.stream_generation(**task_params()))
+
+    # one hires and one detailfix pipeline, the ControlNet is freed after each generation
+    assert builds["pipelines"] == 2
+    assert builds["controlnets"] == 3
+    assert model.task_model_cache[("detailfix", "txt2img")].controlnet is None
+
+
+def test_retained_controlnet_is_loaded_once(model, builds):
+    for _ in range(3):
+        list(model.stream_generation(**task_params(retain_detailfix_model_previous_load=True)))
+
+    assert builds["pipelines"] == 2
+    assert builds["controlnets"] == 1
+
+
+def test_task_model_shares_the_base_components(model):
+    hires_pipe = model.get_task_model("hires")
+    assert model.get_task_model("hires") is hires_pipe
+    assert hires_pipe.unet is model.pipe.unet
+
+
+def test_base_model_change_clears_task_models(model, tmp_path):
+    hires_pipe = model.get_task_model("hires")
+    model.load_pipe(save_tiny_model("sd1.5", str(tmp_path / "other"), seed=1), type_model_precision=torch.float32)
+
+    assert not model.task_model_cache
+    other_pipe = model.get_task_model("hires")
+    assert other_pipe is not hires_pipe
+    assert other_pipe.unet is model.pipe.unet
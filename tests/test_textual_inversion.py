@@ -0,0 +1,112 @@
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from stablepy.diffusers_vanilla import textual_inversion
+from stablepy.diffusers_vanilla.multi_emphasis_prompt import prompt_chunk_cache
+
+
+@pytest.fixture
+def embeddings(sd15_model, tmp_path):
+    dim = sd15_model.pipe.text_encoder.get_input_embeddings().weight.shape[-1]
+    paths = {}
+    for seed, name in enumerate(["zq", "wv"]):
+        generator = torch.Generator().manual_seed(seed)
+        paths[name] = str(tmp_path / f"{name}.safetensors")
+        save_file({"emb_params": torch.randn(1, dim, generator=generator) * 5}, paths[name])
+    yield paths
+    sd15_model.create_prompt_embeds("", "", [], False, "Classic")
+
+
+def encode(model, prompt, textual_inversion):
+    return model.create_prompt_embeds(prompt, "", textual_inversion, False, "Classic-original")[0]
+
+
+@pytest.mark.parametrize("token_removal", [True, False])
+def test_unload_then_load_another_embedding(sd15_model, embeddings, monkeypatch, token_removal):
+    if not token_removal:
+        monkeypatch.setattr(textual_inversion, "supports_token_removal", lambda tokenizer: False)
+
+    encode(sd15_model, "zq cat", [("zq", embeddings["zq"])])
+    encode(sd15_model, "zq cat", [])
+    # wv takes the id that zq had
+    cached = encode(sd15_model, "zq cat", [("wv", embeddings["wv"])])
+
+    prompt_chunk_cache.clear()
+    fresh = encode(sd15_model, "zq cat", [("wv", embeddings["wv"])])
+    assert torch.equal(cached, fresh)
+    assert "zq" not in sd15_model.pipe.tokenizer.added_tokens_encoder
+
+
+@pytest.mark.parametrize("token_removal", [True, False])
+def test_unload_keeps_the_other_embeddings(sd15_model, embeddings, monkeypatch, token_removal):
+    if not token_removal:
+        monkeypatch.setattr(textual_inversion, "supports_token_removal", lambda tokenizer: False)
+    pipe = sd15_model.pipe
+    both = [("zq", embeddings["zq"]), ("wv", embeddings["wv"])]
+
+    encode(sd15_model, "cat", both)
+    encode(sd15_model, "cat", both[1:])
+
+    assert "zq" not in pipe.tokenizer.added_tokens_encoder
+    wv_id = pipe.tokenizer.convert_tokens_to_ids("wv")
+    expected = textual_inversion.load_embedding_file(embeddings["wv"])["emb_params"][0]
+    assert torch.equal(pipe.text_encoder.get_input_embeddings().weight[wv_id], expected)
+    assert pipe.text_encoder.get_input_embeddings().weight.shape[0] == len(pipe.tokenizer)
+
+
+def test_failed_embedding_is_skipped(sd15_model, embeddings):
+    pipe = sd15_model.pipe
+    vocabulary_size = len(pipe.tokenizer)
+    # "cat</w>" is in the vocabulary, diffusers refuses it
+    requested = [("zq", embeddings["zq"]), ("cat</w>", embeddings["wv"]), ("wv", embeddings["wv"])]
+
+    manager = sd15_model.textual_inversion_manager
+    assert manager.sync(pipe, requested, verbose=False) == ["zq", "wv"]
+    assert len(pipe.tokenizer) == vocabulary_size + 2
+    assert pipe.text_encoder.get_input_embeddings().weight.shape[0] == len(pipe.tokenizer)
+    manager.sync(pipe, [], verbose=False)
+
+
+def test_failure_on_the_second_encoder_is_rolled_back(tmp_path, monkeypatch):
+    from diffusers import StableDiffusionXLPipeline
+    from benchmarks.tiny_models import save_tiny_model
+
+    pipe = StableDiffusionXLPipeline.from_pretrained(save_tiny_model("sdxl", str(tmp_path / "sdxl")))
+    sizes = [(len(tokenizer), encoder.get_input_embeddings().weight.shape[0])
+             for _, tokenizer, encoder in textual_inversion.TextualInversionManager.text_encoders(pipe)]
+    path = str(tmp_path / "xl.safetensors")
+    save_file({
+        "clip_l": torch.randn(2, pipe.text_encoder.config.hidden_size),
+        "clip_g": torch.randn(2, pipe.text_encoder_2.config.hidden_size),
+    }, path)
+
+    load = pipe.load_textual_inversion
+
+    def fails_after_resizing(*args, text_encoder=None, **kwargs):
+        load(*args, text_encoder=text_encoder, **kwargs)
+        if text_encoder is pipe.text_encoder_2:
+            raise RuntimeError("second encoder failed")
+
+    monkeypatch.setattr(pipe, "load_textual_inversion", fails_after_resizing)
+    manager = textual_inversion.TextualInversionManager()
+    assert manager.sync(pipe, [("zq", path)], verbose=False) == []
+    assert [(len(tokenizer), encoder.get_input_embeddings().weight.shape[0])
+            for _, tokenizer, encoder in manager.text_encoders(pipe)] == sizes
+
+
+def test_embedding_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(textual_inversion, "EMBEDDING_CACHE_SIZE", 2)
+    monkeypatch.setattr(textual_inversion, "_embedding_cache", type(textual_inversion._embedding_cache)())
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / f"e{i}.safetensors"))
+        save_file({"emb_params": torch.randn(1, 8)}, paths[-1])
+
+    first = textual_inversion.load_embedding_file(paths[0])
+    textual_inversion.load_embedding_file(paths[1])
+    assert textual_inversion.load_embedding_file(paths[0]) is first
+    textual_inversion.load_embedding_file(paths[2])
+
+    cached = {key[0] for key in textual_inversion._embedding_cache}
+    assert len(cached) == 2 and textual_inversion.os.path.realpath(paths[1]) not in cached
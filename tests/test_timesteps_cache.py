@@ -0,0 +1,98 @@
+import copy
+import inspect
+import pickle
+
+import numpy as np
+import pytest
+import torch
+from diffusers import DPMSolverMultistepScheduler, EulerDiscreteScheduler
+
+from stablepy.diffusers_vanilla.constants import SCHEDULER_CONFIG_MAP
+from stablepy.diffusers_vanilla.timesteps_cache import CachedSetTimesteps, cache_timesteps, copy_scheduler
+
+BASE_CONFIG = EulerDiscreteScheduler(beta_schedule="scaled_linear", beta_start=0.00085, beta_end=0.012).config
+
+
+def equal(first, second):
+    if torch.is_tensor(first):
+        return torch.allclose(first, second, rtol=0, atol=0, equal_nan=True)
+    if isinstance(first, np.ndarray):
+        return np.array_equal(first, second, equal_nan=first.dtype.kind == "f")
+    if isinstance(first, (list, tuple)):
+        return len(first) == len(second) and all(equal(a, b) for a, b in zip(first, second))
+    return first == second
+
+
+def cached_scheduler(name="DPM++ 2M Karras"):
+    scheduler_class, config = SCHEDULER_CONFIG_MAP[name]
+    return cache_timesteps(scheduler_class.from_config(BASE_CONFIG, **config))
+
+
+@pytest.mark.parametrize("name", list(SCHEDULER_CONFIG_MAP))
+def test_cached_state_matches_set_timesteps(name):
+    scheduler_class, config = SCHEDULER_CONFIG_MAP[name]
+    try:
+        reference = scheduler_class.from_config(BASE_CONFIG, **config)
+        reference.set_timesteps(9, device="cpu")
+    except Exception as exception:
+        pytest.skip(f"{name}: {exception}")
+
+    # the second one is restored from the cache
+    for _ in range(2):
+        scheduler = cached_scheduler(name)
+        scheduler.set_timesteps(9, device="cpu")
+        for attribute, value in vars(reference).items():
+            if attribute != "set_timesteps":
+                assert equal(value, vars(scheduler)[attribute]), attribute
+
+
+def test_class_is_unchanged():
+    scheduler = cached_scheduler()
+    assert type(scheduler) is DPMSolverMultistepScheduler
+    assert isinstance(scheduler, DPMSolverMultistepScheduler)
+    # the pipelines check the accepted arguments
+    assert "timesteps" in inspect.signature(scheduler.set_timesteps).parameters
+
+
+def test_in_place_edits_dont_change_the_cache():
+    scheduler = cached_scheduler()
+    scheduler.set_timesteps(12)
+    expected = scheduler.sigmas.clone()
+    scheduler.sigmas.mul_(0)
+    scheduler.model_outputs[0] = torch.ones(1)
+
+    other = cached_scheduler()
+    other.set_timesteps(12)
+    assert torch.equal(other.sigmas, expected)
+    assert other.model_outputs[0] is None
+
+
+def test_other_attributes_are_kept():
+    scheduler = cached_scheduler()
+    scheduler.set_timesteps(14)
+    other = cached_scheduler()
+    other.custom_label = "kept"
+    other.set_timesteps(14)
+    assert other.custom_label == "kept"
+
+
+def test_copies_cache_their_own_state():
+    scheduler = cached_scheduler()
+    scheduler_copy = copy_scheduler(scheduler)
+    scheduler.set_timesteps(6)
+    scheduler_copy.set_timesteps(16)
+    assert scheduler.num_inference_steps == 6
+    assert scheduler_copy.num_inference_steps == 16
+
+
+@pytest.mark.parametrize("duplicate", [lambda s: pickle.loads(pickle.dumps(s)), copy.deepcopy])
+def test_pickle_and_deepcopy(duplicate):
+    scheduler = cached_scheduler()
+    scheduler.set_timesteps(8)
+    duplicated = duplicate(scheduler)
+    assert type(duplicated) is DPMSolverMultistepScheduler
+    assert isinstance(vars(duplicated)["set_timesteps"], CachedSetTimesteps)
+
+    duplicated.set_timesteps(18)
+    assert duplicated.num_inference_steps == 18
+    assert scheduler.num_inference_steps == 8
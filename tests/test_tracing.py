@@ -0,0 +1,32 @@
+import pytest
+
+from stablepy import GenerationProfiler, CancellationToken, GenerationCancelled, start_trace, stop_trace
+from tests.helpers import generation_params
+
+
+@pytest.fixture
+def recorder():
+    recorder = start_trace()
+    yield recorder
+    stop_trace()
+
+
+def test_trace_is_removed_after_the_generation(sd15_model, recorder):
+    vae = sd15_model.pipe.vae
+    profiler = GenerationProfiler()
+    sd15_model(profiler=profiler, **generation_params())
+
+    names = {event["name"] for event in recorder.events}
+    assert {"vae_decode", "denoise", "step 0"} <= names
+    assert "decode" not in vars(vae)
+    assert profiler.hooks == []
+
+
+def test_trace_is_removed_after_a_cancellation(sd15_model, recorder):
+    token = CancellationToken()
+    profiler = GenerationProfiler(hooks=[lambda record: record["type"] == "step" and token.cancel()])
+    with pytest.raises(GenerationCancelled):
+        sd15_model(profiler=profiler, cancellation_token=token, **generation_params())
+
+    assert "decode" not in vars(sd15_model.pipe.vae)
+    assert recorder not in profiler.hooks
@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+import torch
+
+from stablepy import Model_Diffusers
+from tests.helpers import generation_params, weights
+
+# add, remove + rescale + add, reorder, remove + add back, repeated path, nothing
+LORA_SETS = [
+    [(0, 0.8), (1, 0.5)],
+    [(1, 0.3), (2, 1.0)],
+    [(2, 1.0), (1, 0.3)],
+    [(0, -0.4), (2, 0.7)],
+    [(0, 0.2), (2, 0.7), (0, 0.2)],
+    [],
+]
+
+
+def test_incremental_update_matches_a_fresh_load(sd15_model, sd15_folder, lora_paths):
+    try:
+        for lora_set in LORA_SETS:
+            loras = [(lora_paths[i], scale) for i, scale in lora_set]
+            sd15_model.update_loras(loras)
+
+            fresh = Model_Diffusers(base_model_id=sd15_folder, task_name="txt2img", type_model_precision=torch.float32)
+            fresh.update_loras(loras)
+
+            assert sd15_model.lora_memory == fresh.lora_memory
+            expected = weights(fresh.pipe)
+            for key, value in weights(sd15_model.pipe).items():
+                torch.testing.assert_close(value, expected[key], rtol=1e-5, atol=1e-6, msg=f"{lora_set} {key}")
+
+            params = generation_params(loras=loras)
+            image = np.asarray(sd15_model(**params)[0][0], dtype=np.float32)
+            expected_image = np.asarray(fresh(**params)[0][0], dtype=np.float32)
+            assert np.abs(image - expected_image).max() <= 1
+    finally:
+        sd15_model.update_loras([])
@@ -0,0 +1,61 @@
+import os
+import time
+import queue
+
+import pytest
+import torch
+
+from stablepy import ModelWorkerPool, WorkerError
+
+
+class FakeModel:
+    device = torch.device("cpu")
+
+    def __call__(self, mode="ok", sleep=0):
+        time.sleep(sleep)
+        if mode == "die":
+            os._exit(3)
+        if mode == "raise":
+            raise KeyError("boom")
+        return ["image"], ["path"]
+
+
+@pytest.fixture
+def pool():
+    pool = ModelWorkerPool(FakeModel(), num_workers=2, pin_cores=False)
+    yield pool
+    for worker in pool.workers:
+        worker.terminate()
+        worker.join()
+
+
+def test_result(pool):
+    job = pool.submit()
+    assert pool.result(job, timeout=30) == (["image"], ["path"])
+
+
+def test_error_has_type_and_traceback(pool):
+    job = pool.submit(mode="raise")
+    with pytest.raises(WorkerError) as error:
+        pool.result(job, timeout=30)
+    assert error.value.exc_type == "KeyError"
+    assert "raise KeyError" in error.value.worker_traceback
+
+
+def test_timeout_covers_the_whole_wait(pool):
+    slow = pool.submit(sleep=3)
+    for _ in range(3):
+        pool.submit()
+    start = time.monotonic()
+    with pytest.raises(queue.Empty):
+        pool.result(slow, timeout=1)
+    assert time.monotonic() - start < 2
+
+
+def test_dead_worker(pool):
+    job = pool.submit(mode="die")
+    with pytest.raises(WorkerError):
+        pool.result(job)
+    # the other worker keeps running jobs
+    job = pool.submit()
+    assert pool.result(job, timeout=30) == (["image"], ["path"])